@@ -0,0 +1,57 @@
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+import os
+import sys
+import pdb
+
+import argparse
+
+sys.path.append('../')
+from testers import load_model_path
+from utils import get_config, load_rb
+from helpers import create_loaders
+from grads import per_sample_grads, grad_stats
+
+# per-trial gradients of a trained model on a batch of its dataset: diagonal fisher of each
+# trained parameter, and how the gradient norms are spread out in every context
+
+def main(args):
+    config = get_config(args.model, ctype='model', to_bunch=True)
+    net = load_model_path(args.model, config)
+    if args.dataset is not None:
+        config.dataset = args.dataset
+    else:
+        # dataset paths in configs are relative to the main folder
+        config.dataset = [d if os.path.isabs(d) else '../' + d for d in config.dataset]
+    config.sequential = False
+    _, loader = create_loaders(config.dataset, config, split_test=False, test_size=args.n_trials)
+    x, y, trials = next(iter(loader))
+    t_lens = torch.as_tensor([t.t_len for t in trials])
+
+    names = [k for k, v in net.named_parameters() if any(part in k for part in config.train_parts)]
+    grads = per_sample_grads(net, x, y, t_lens, names, config.res_x_init)
+    stats = grad_stats(grads, [t.context for t in trials])
+
+    for k, f in stats['fisher'].items():
+        print(f'{k}: fisher mean {f.mean().item():.4g}, max {f.max().item():.4g}')
+    for c, s in stats['contexts'].items():
+        print(f'context {c}: {len(s["norms"])} trials, grad norm {s["norms"].mean().item():.4g}'
+              f' +- {s["norms"].std().item():.4g}, norm of mean grad {s["mean_grad_norm"]:.4g}')
+
+    if not args.no_plot:
+        for c, s in stats['contexts'].items():
+            plt.hist(s['norms'].numpy(), bins=20, alpha=.5, label=f'context {c}')
+        plt.xlabel('per-trial gradient norm')
+        plt.legend()
+        plt.show()
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('model')
+    ap.add_argument('-d', '--dataset', nargs='+', default=None)
+    ap.add_argument('-n', '--n_trials', type=int, default=100)
+    ap.add_argument('--no_plot', action='store_true')
+    args = ap.parse_args()
+
+    main(args)
@@ -8,8 +8,7 @@ import sys
 
 sys.path.append('../')
 
-# from testers import load_model, test_model
-from network import M2Net
+from testers import load_model_path
 from utils import Bunch, load_rb, get_config
 
 
@@ -20,10 +19,8 @@ args = parser.parse_args()
 
 nets = []
 for path in args.models:
-    config = get_config(path)
-    # with open(path, 'rb') as f:
-    net = M2Net(config)
-    net.load_state_dict(torch.load(path))
+    # also rebuilds the reservoir for compact model files
+    net = load_model_path(path)
     nets.append(net)
     
 pdb.set_trace()
@@ -0,0 +1,343 @@
+import numpy as np
+
+import os
+import json
+import pickle
+import argparse
+import pdb
+
+# columnar storage for task datasets
+# instead of a pickled list of Task objects, a dataset is one .npz file holding every
+# per-trial parameter as an array with the trial as leading dimension, plus a json header
+# with everything that's shared between trials. reading it back doesn't touch tasks.py
+
+# per-trial columns for each kind of task, named as the Task attributes they come from
+# datasets sampled in batches by tasks.py can use other columns (e.g. DelayCopy keeps freqs, amps)
+COLUMNS = {
+    'RSG': ['rsg', 't_o', 't_p'],
+    'CSG': ['csg', 't_p', 't_percentile'],
+    'DelayProAnti': ['stimulus'],
+    'MemoryProAnti': ['stimulus'],
+    'DelayCopy': ['pattern'],
+    'FlipFlop': ['keys'],
+    'DurationDisc': ['s1', 's2', 'cue_id', 'direction'],
+}
+
+# attributes that are the same for every trial in a dataset, saved in the header
+SHARED = {
+    'RSG': ['p_len'],
+    'CSG': ['p_len'],
+    'DelayProAnti': ['fix', 'stim'],
+    'MemoryProAnti': ['fix', 'stim', 'memory'],
+    'DelayCopy': ['dim', 's_len'],
+    'FlipFlop': ['dim', 'p_len'],
+    'DurationDisc': ['cue_t', 'select_t'],
+}
+
+DTYPES = {
+    'rsg': np.int32,
+    'csg': np.int32,
+    't_o': np.int32,
+    't_p': np.int32,
+    't_percentile': np.float64,
+    'stimulus': np.float64,
+    'pattern': np.float64,
+    'keys': np.int32,
+    's1': np.int32,
+    's2': np.int32,
+    'cue_id': np.int8,
+    'direction': bool,
+    'freqs': np.float64,
+    'amps': np.float64,
+}
+
+
+# a whole dataset as columns. slicing gives another table with views into the same arrays,
+# integer indexing gives a single trial that behaves like the original Task object
+class TrialTable:
+    def __init__(self, header, columns):
+        self.header = header
+        self.columns = columns
+        self.kind = header['kind']
+
+    def __len__(self):
+        return len(self.columns['n'])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return TrialTable(self.header, {k: v[idx] for k, v in self.columns.items()})
+        return TableTrial(self, idx)
+
+    # new table with just the rows in idxs, in that order
+    def take(self, idxs):
+        return TrialTable(self.header, {k: v[idxs] for k, v in self.columns.items()})
+
+
+# one row of a TrialTable, with the same attributes and get_x/get_y as the Task it came from
+class TableTrial:
+    def __init__(self, table, idx):
+        # header has kind, t_type, t_len, L, Z, dset_id and the shared attributes
+        for k, v in table.header.items():
+            setattr(self, k, v)
+        for k, v in table.columns.items():
+            setattr(self, k, v[idx])
+        self.n = int(self.n)
+        self.table = table
+        self.idx = idx
+        # x and y render together, and without input noise they're the same every time
+        self.rendered = None
+
+        # turn arrays back into the python types the Task objects use
+        if self.kind == 'RSG':
+            self.rsg = tuple(int(t) for t in self.rsg)
+        elif self.kind == 'CSG':
+            self.csg = tuple(int(t) for t in self.csg)
+        elif self.kind == 'FlipFlop':
+            # keys are padded with 0, which is never a real key
+            self.keys = [[int(k) for k in ks if k != 0] for ks in self.keys]
+        elif self.kind == 'DurationDisc':
+            self.s1 = [int(t) for t in self.s1]
+            self.s2 = [int(t) for t in self.s2]
+            self.cue_id = int(self.cue_id)
+            self.direction = bool(self.direction)
+
+    # single trials are just batches of one. targets never have noise in them
+    def render(self, args=None):
+        noisy = args is not None and (args.m_noise != 0 or (hasattr(args, 'x_noise') and args.x_noise != 0))
+        if noisy:
+            x, y = render_table(self.table.take([self.idx]), args)
+            return x[0], y[0]
+        if self.rendered is None:
+            x, y = render_table(self.table.take([self.idx]))
+            self.rendered = (x[0], y[0])
+        return self.rendered
+
+    # copies, so changing one doesn't change the cached pair
+    def get_x(self, args=None):
+        return self.render(args)[0].copy()
+
+    def get_y(self, args=None):
+        return self.render()[1].copy()
+
+
+# batch renderers, one per kind of task. each takes the columns of b trials and writes
+# their inputs and targets into x [b, L, t_len] and y [b, Z, t_len], which start out as zeros
+# these match get_x/get_y of the classes in tasks.py
+
+# [b, t_len] mask that's on from start to start + length
+def pulses(t_len, start, length):
+    t = np.arange(t_len)
+    start = np.reshape(start, (-1, 1))
+    return (t >= start) & (t < start + np.reshape(length, (-1, 1)))
+
+# clipped ramp that hits 1 at interval t_p after t_start, used for the rsg and csg targets
+def ramps(t_len, t_start, t_p):
+    t = np.arange(t_len)
+    y = (t - np.reshape(t_start, (-1, 1))) / np.reshape(t_p, (-1, 1))
+    return np.clip(y, 0, 1.5)
+
+def render_rsg(cols, h, x, y, args=None, rng=np.random):
+    rt = cols['rsg'][:,0]
+    st = cols['rsg'][:,1]
+    t_len = h['t_len']
+    # perceptual shift of the ready pulse, which wraps around like np.roll
+    if args is not None and args.m_noise != 0:
+        disp = np.trunc(rng.normal(0, args.m_noise * cols['t_o'] / 50)).astype(int)
+        x[:,0] = (np.arange(t_len) - np.reshape(rt + disp, (-1, 1))) % t_len < h['p_len']
+    else:
+        x[:,0] = pulses(t_len, rt, h['p_len'])
+    x[:,0] += pulses(t_len, st, h['p_len'])
+    # noisy up/down corruption
+    if args is not None and args.x_noise != 0:
+        x += rng.normal(scale=args.x_noise, size=x.shape)
+    y[:,0] = ramps(t_len, st, cols['t_p'])
+
+def render_csg(cols, h, x, y, args=None, rng=np.random):
+    ct = cols['csg'][:,0]
+    st = cols['csg'][:,1]
+    cue = 0.5 + 0.5 * np.reshape(cols['t_percentile'], (-1, 1))
+    x[:,0] = pulses(h['t_len'], ct, h['p_len']) * cue + pulses(h['t_len'], st, h['p_len'])
+    y[:,0] = ramps(h['t_len'], st, cols['t_p'])
+
+# delay and memory pro/anti only differ in when the stimulus is shown and the response starts
+def render_pro_anti(cols, h, x, y, stim_on, stim_off, go):
+    stimulus = cols['stimulus'][:,:,None]
+    x[:,0,:go] = 1
+    x[:,1:,stim_on:stim_off] = stimulus
+    y[:,0,:go] = 1
+    if h['t_type'].endswith('anti'):
+        stimulus = -stimulus
+    y[:,1:,go:] = stimulus
+
+def render_dpa(cols, h, x, y, args=None, rng=np.random):
+    render_pro_anti(cols, h, x, y, h['fix'], h['t_len'], h['stim'])
+
+def render_mpa(cols, h, x, y, args=None, rng=np.random):
+    render_pro_anti(cols, h, x, y, h['fix'], h['stim'], h['memory'])
+
+# converted datasets store the pattern, sampled ones only its sine components
+def render_copy(cols, h, x, y, args=None, rng=np.random):
+    if 'pattern' in cols:
+        pattern = cols['pattern']
+    else:
+        x_r = np.arange(h['s_len'])
+        sines = np.sin(1 / cols['freqs'][...,None] * x_r)
+        pattern = np.einsum('bdf,bdft->bdt', cols['amps'], sines) / np.sqrt(h['n_freqs'])
+    s_len = h['s_len']
+    x[:,:,:s_len] = pattern
+    y[:,:,s_len:] = pattern
+
+def render_ff(cols, h, x, y, args=None, rng=np.random):
+    keys = cols['keys']
+    t = np.arange(h['t_len'])
+    # padding keys are 0, so push them past the end of the trial
+    starts = np.where(keys == 0, h['t_len'], np.abs(keys))
+    signs = np.sign(keys)
+    # [b, dim, n_keys, t_len] pulses; keys never overlap so summing is fine
+    on = (t >= starts[...,None]) & (t < starts[...,None] + h['p_len'])
+    x[:] = np.einsum('bdk,bdkt->bdt', signs, on)
+    # targets hold the sign of the most recent key, and 0 before the first one
+    n_started = np.sum(t >= starts[...,None], axis=2)
+    last = np.take_along_axis(signs, np.maximum(n_started - 1, 0), axis=2)
+    y[:] = np.where(n_started > 0, last, 0)
+
+def render_dd(cols, h, x, y, args=None, rng=np.random):
+    x[:,0] = pulses(h['t_len'], cols['s1'][:,0], cols['s1'][:,1])
+    x[:,1] = pulses(h['t_len'], cols['s2'][:,0], cols['s2'][:,1])
+    cue = np.reshape(cols['cue_id'] == 1, (-1, 1))
+    x[:,2,h['cue_t']:] = cue
+    x[:,3,h['cue_t']:] = ~cue
+    direction = np.reshape(cols['direction'], (-1, 1))
+    y[:,0,h['select_t']:] = direction
+    y[:,1,h['select_t']:] = ~direction
+
+RENDERERS = {
+    'RSG': render_rsg,
+    'CSG': render_csg,
+    'DelayProAnti': render_dpa,
+    'MemoryProAnti': render_mpa,
+    'DelayCopy': render_copy,
+    'FlipFlop': render_ff,
+    'DurationDisc': render_dd,
+}
+
+# render every trial of a table. x and y can be preallocated (zeroed) arrays with at least
+# [len(table), L, t_len] and [len(table), Z, t_len], otherwise new float32 ones are made
+# rng is used for input noise; either np.random or a np.random.Generator
+def render_table(table, args=None, x=None, y=None, rng=np.random):
+    h = table.header
+    if x is None:
+        x = np.zeros((len(table), h['L'], h['t_len']), dtype=np.float32)
+    if y is None:
+        y = np.zeros((len(table), h['Z'], h['t_len']), dtype=np.float32)
+    # basic slicing, so these are views into x and y
+    x_view = x[:, :h['L'], :h['t_len']]
+    y_view = y[:, :h['Z'], :h['t_len']]
+    RENDERERS[table.kind](table.columns, h, x_view, y_view, args, rng)
+    return x, y
+
+
+# turn a list of Task objects (as stored in the old pickles) into a TrialTable
+def trials_to_table(trials):
+    ex = trials[0]
+    kind = type(ex).__name__
+    if kind not in COLUMNS:
+        raise NotImplementedError(f'no columnar format for {kind}')
+
+    header = {
+        'kind': kind,
+        't_type': ex.t_type,
+        't_len': int(ex.t_len),
+        'L': int(ex.L),
+        'Z': int(ex.Z),
+        'dset_id': ex.dset_id,
+    }
+    for k in SHARED[kind]:
+        header[k] = int(getattr(ex, k))
+
+    columns = {}
+    ns = [t.n if t.n is not None else i for i, t in enumerate(trials)]
+    columns['n'] = np.array(ns, dtype=np.int64)
+    for k in COLUMNS[kind]:
+        if k == 'keys':
+            # pad the ragged [dim, n_keys] lists into [n, dim, max_keys]
+            max_keys = max(max(len(ks) for ks in t.keys) for t in trials)
+            col = np.zeros((len(trials), header['dim'], max(max_keys, 1)), dtype=DTYPES[k])
+            for i, t in enumerate(trials):
+                for j, ks in enumerate(t.keys):
+                    col[i, j, :len(ks)] = ks
+        else:
+            col = np.array([getattr(t, k) for t in trials], dtype=DTYPES[k])
+        columns[k] = col
+
+    return TrialTable(header, columns)
+
+# join columns of several chunks of the same dataset, zero-padding ragged trailing
+# dimensions (like the number of flip-flop keys) up to the largest chunk
+def concat_columns(chunks):
+    columns = {}
+    for k in chunks[0].keys():
+        arrs = [c[k] for c in chunks]
+        shape = np.max([a.shape for a in arrs], axis=0)
+        padded = []
+        for a in arrs:
+            pads = [(0, 0)] + [(0, s - d) for s, d in zip(shape[1:], a.shape[1:])]
+            padded.append(np.pad(a, pads))
+        columns[k] = np.concatenate(padded).astype(DTYPES.get(k, arrs[0].dtype))
+    return columns
+
+def save_table(table, path):
+    header = np.array(json.dumps(table.header))
+    with open(path, 'wb') as f:
+        np.savez(f, __header__=header, **table.columns)
+
+def load_table(path):
+    with np.load(path) as f:
+        header = json.loads(str(f['__header__']))
+        columns = {k: f[k] for k in f.files if k != '__header__'}
+    return TrialTable(header, columns)
+
+# old pickles were made by running tasks.py, so their trials are __main__.RSG and so on. when __main__
+# is something else, like this file, they're found in tasks instead
+class TaskUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        try:
+            return super().find_class(module, name)
+        except AttributeError:
+            if module != '__main__':
+                raise
+            # imported here since tasks imports this module
+            import tasks
+            return getattr(tasks, name)
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return TaskUnpickler(f).load()
+
+# load a dataset from either format; .npz is columnar, anything else is an old pickle
+def load_dataset(path):
+    if path.endswith('.npz'):
+        return load_table(path)
+    return load_pickle(path)
+
+# convert an old pickled dataset into a .npz next to it (or in out_dir)
+def convert_pickle(path, out_dir=None):
+    trials = load_pickle(path)
+    table = trials_to_table(trials)
+    head, tail = os.path.split(path)
+    if out_dir is None:
+        out_dir = head
+    out_path = os.path.join(out_dir, '.'.join(tail.split('.')[:-1]) + '.npz')
+    save_table(table, out_path)
+    return out_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='pickled datasets to convert')
+    parser.add_argument('-o', '--out_dir', default=None, help='where to put the .npz files. default is next to the pickles')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        out_path = convert_pickle(path, args.out_dir)
+        print(f'{path} -> {out_path}')
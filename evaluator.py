@@ -0,0 +1,174 @@
+import torch
+import torch.multiprocessing as mp
+
+import os
+import time
+import queue
+import pdb
+
+from network import M2Net, compact_state_dict
+from helpers import get_criteria, atomic_save, join_eval_sets
+
+# testing in a separate process, so training doesn't stop every log_interval to do it.
+# the trainer copies its trainable weights into one of a few shared memory slots and asks for a
+# test; the worker copies them into its own network, frees the slot, and tests every task that's due.
+# it also keeps track of the best model so far, and saves it.
+# when all the slots are taken the trainer waits, so results are never more than a few tests behind
+
+# loss over a fixed evaluation set, same as Trainer.test
+def eval_loss(net, args, criteria, eval_set):
+    total_loss = 0.
+    n_trials = 0
+    with torch.no_grad():
+        for x, y, trials in eval_set:
+            net.reset(args.res_x_init)
+            outs = torch.stack([net(x[:,:,j]) for j in range(x.shape[2])], dim=2)
+            for c in criteria:
+                total_loss += c(outs, y, i=trials, t_ix=0).item()
+            n_trials += len(x)
+    return total_loss / n_trials
+
+# losses on each of the eval sets in a join_eval_sets, from a single rollout
+def joint_eval_losses(net, args, criteria, joint):
+    x, y, trials, sets = joint
+    losses = []
+    with torch.no_grad():
+        net.reset(args.res_x_init, device=x.device)
+        outs = torch.stack([net(x[:,:,j]) for j in range(x.shape[2])], dim=2)
+        # each batch cut back to its own length, which is what testing it by itself sees
+        for batches in sets:
+            loss = 0.
+            n = 0
+            for lo, hi, T in batches:
+                for c in criteria:
+                    loss += c(outs[lo:hi,:,:T], y[lo:hi,:,:T], i=trials[lo:hi], t_ix=0).item()
+                n += hi - lo
+            losses.append(loss / n)
+    return losses
+
+def eval_worker(args, state_dict, slots, eval_sets, run_dir, requests, free_slots, results, best):
+    # leave the cores to training
+    torch.set_num_threads(1)
+    net = M2Net(args)
+    net.load_state_dict(state_dict)
+    params = dict(net.named_parameters())
+    criteria = get_criteria(args)
+
+    # (task, loss) of the best model so far; a resumed run doesn't start from scratch
+    best_task, best_loss = best
+    # earlier tasks' eval sets joined together, for the ones being tested now
+    joint = {}
+    while True:
+        req = requests.get()
+        if req is None:
+            break
+        slot, ix, train_idx, tests, train_loss = req
+        with torch.no_grad():
+            for k, v in slots[slot].items():
+                params[k].copy_(v)
+        free_slots.put(slot)
+
+        # tests[0] is the task being trained, the rest are earlier tasks, all tested at once
+        losses = [(tests[0][0], eval_loss(net, args, criteria, eval_sets[tests[0][1]]))]
+        if len(tests) > 1:
+            key = tuple(c for i, c in tests[1:])
+            if key not in joint:
+                joint = {key: join_eval_sets([eval_sets[c] for c in key])}
+            losses.extend(zip([i for i, c in tests[1:]], joint_eval_losses(net, args, criteria, joint[key])))
+        test_loss = losses[0][1]
+
+        # best model is per task, like the trainer's convergence testing
+        if train_idx != best_task:
+            best_task = train_idx
+            best_loss = float('inf')
+        is_best = test_loss < best_loss
+        if is_best:
+            best_loss = test_loss
+            if run_dir is not None:
+                if hasattr(args, 'full_models') and args.full_models:
+                    state = net.state_dict()
+                else:
+                    state = compact_state_dict(net, slots[0].keys())
+                atomic_save(state, os.path.join(run_dir, 'model_best.pth'))
+
+        results.put({
+            'ix': ix,
+            'train_idx': train_idx,
+            'train_loss': train_loss,
+            'test_loss': test_loss,
+            'task_losses': losses[1:],
+            'best': is_best
+        })
+    results.put(None)
+
+
+class AsyncEvaluator:
+    def __init__(self, net, params, eval_sets, args, run_dir=None, n_slots=2, best=(None, float('inf'))):
+        ctx = mp.get_context('spawn')
+        self.params = params
+        self.slots = []
+        for i in range(n_slots):
+            self.slots.append({k: v.detach().cpu().clone().share_memory_() for k, v in params.items()})
+        cpu_sets = [[(x.cpu(), y.cpu(), trials) for x, y, trials in es] for es in eval_sets]
+        state_dict = {k: v.cpu() for k, v in net.state_dict().items()}
+
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.free_slots = ctx.Queue()
+        for i in range(n_slots):
+            self.free_slots.put(i)
+
+        self.proc = ctx.Process(
+            target=eval_worker,
+            args=(args, state_dict, self.slots, cpu_sets, run_dir, self.requests, self.free_slots, self.results, best),
+            daemon=True
+        )
+        self.proc.start()
+        self.n_pending = 0
+        # time the trainer spent waiting for a free slot
+        self.wait_time = 0.
+
+    # blocking get that doesn't hang if the worker has died
+    def get(self, q):
+        while True:
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                if not self.proc.is_alive():
+                    raise RuntimeError(f'evaluation worker died with exit code {self.proc.exitcode}')
+
+    # snapshot the current weights and queue up a test. tests are (task number, eval set index) pairs
+    def submit(self, ix, train_idx, tests, train_loss):
+        t = time.perf_counter()
+        slot = self.get(self.free_slots)
+        self.wait_time += time.perf_counter() - t
+        with torch.no_grad():
+            for k, v in self.params.items():
+                self.slots[slot][k].copy_(v)
+        self.requests.put((slot, ix, train_idx, tests, train_loss))
+        self.n_pending += 1
+
+    # results that have arrived so far, in order
+    def poll(self):
+        results = []
+        while self.n_pending > 0:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            results.append(result)
+            self.n_pending -= 1
+        return results
+
+    # wait for everything still pending, then stop the worker
+    def close(self):
+        results = []
+        self.requests.put(None)
+        while True:
+            result = self.get(self.results)
+            if result is None:
+                break
+            results.append(result)
+        self.proc.join()
+        self.n_pending = 0
+        return results
@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+
+import pdb
+
+# torch.func is only in torch 2.0 and later
+try:
+    from torch.func import functional_call, grad, vmap
+except ImportError:
+    functional_call = None
+
+# per-trial gradients of the trained parameters, for fisher information and other gradient statistics.
+# the loss of a single trial is written as a function of the parameters, and torch.func differentiates
+# it and vectorizes it over the batch, so every trial's gradient comes out of one pass instead of a
+# backward per trial. the loss is the same masked mse the trainer uses, without the 1/batch_size
+
+# gradients of every trial in x [B, L+T, time] and y [B, Z, time], counting each trial up to its t_len.
+# names are the parameters to differentiate, e.g. Trainer.n_params. gives {name: [B, *shape]}
+def per_sample_grads(net, x, y, t_lens, names, res_state=None):
+    if functional_call is None:
+        raise ImportError('per-sample gradients need torch.func, from torch 2.0')
+    params = {k: v.detach() for k, v in net.named_parameters() if k in names}
+    others = {k: v.detach() for k, v in net.named_parameters() if k not in names}
+    others.update(dict(net.named_buffers()))
+    mask = (torch.arange(x.shape[2], device=x.device)[None, :] < t_lens[:, None]).float()
+    # reset (and burn in) once out here, since resetting can draw random states, then start
+    # every trial from the same place
+    net.reset(res_state, device=x.device)
+    state = {}
+    if net.args.use_reservoir:
+        state = {k: getattr(net.reservoir, k) for k in ['x', 'r'] if hasattr(net.reservoir, k)}
+
+    def trial_loss(params, x, y, mask):
+        net.z = torch.zeros((1, net.args.Z), device=x.device)
+        for k, v in state.items():
+            setattr(net.reservoir, k, v)
+        outs = []
+        for j in range(x.shape[1]):
+            outs.append(functional_call(net, (params, others), (x[None, :, j],))[0])
+        outs = torch.stack(outs, dim=1)
+        return ((outs - y) ** 2 * mask).sum()
+
+    grads = vmap(grad(trial_loss), in_dims=(None, 0, 0, 0), randomness='different')(params, x, y, mask)
+    # the network keeps its last state around, which is a vmap tensor by now
+    net.reset(res_state, device=x.device)
+    return grads
+
+# diagonal (empirical) fisher information and gradient norms, overall and for each context
+def grad_stats(grads, contexts):
+    contexts = np.asarray(contexts)
+    flat = torch.cat([g.reshape(len(g), -1) for g in grads.values()], dim=1)
+    stats = {
+        'fisher': {k: (g ** 2).mean(dim=0) for k, g in grads.items()},
+        'norms': flat.norm(dim=1),
+        'contexts': {}
+    }
+    for c in np.unique(contexts):
+        idx = torch.as_tensor(np.nonzero(contexts == c)[0])
+        stats['contexts'][int(c)] = {
+            'fisher': {k: (g[idx] ** 2).mean(dim=0) for k, g in grads.items()},
+            'norms': stats['norms'][idx],
+            'mean_grad_norm': flat[idx].mean(dim=0).norm().item()
+        }
+    return stats
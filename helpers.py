@@ -3,14 +3,19 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data import Dataset, IterableDataset, DataLoader, BatchSampler, SubsetRandomSampler, get_worker_info
 
 import pdb
 
+import os
 import random
+import time
+import queue
+import threading
 from collections import OrderedDict
 
-from utils import load_rb, get_config
+from utils import load_rb, get_config, load_args
+from columnar import load_dataset, trials_to_table, render_table, TrialTable
 
 def sigmoid(x):
     return 1/(1 + np.exp(-x))
@@ -24,7 +29,8 @@ def get_optimizer(args, train_params):
     elif args.optimizer == 'rmsprop':
         op = optim.RMSprop(train_params, lr=args.lr, weight_decay=args.l2_reg)
     elif args.optimizer == 'lbfgs-pytorch':
-        op = optim.LBFGS(train_params, lr=0.75)
+        # a step is log_interval iterations, with as much history as scipy's L-BFGS-B keeps
+        op = optim.LBFGS(train_params, lr=1, max_iter=args.log_interval, history_size=10, line_search_fn='strong_wolfe')
     return op
 
 def get_scheduler(args, op):
@@ -35,57 +41,252 @@ def get_scheduler(args, op):
 
 # dataset that automatically creates trials composed of trial and context data
 # input dataset should be in form [(dname, dset), ...]
+# indexing with a list of indices renders the whole batch at once, into a single pair of tensors
 class TrialDataset(Dataset):
     def __init__(self, datasets, args):
         self.args = args
         
         self.dnames = []    # names of dsets
-        self.data = []      # dsets themselves
+        self.data = []      # dsets themselves, as TrialTables
         self.t_types = []   # task type
         self.lzs = []       # Ls and Zs for task trials
-        self.x_ctxs = []    # precomputed context inputs
         self.max_idxs = np.zeros(len(datasets), dtype=int)
         self.t_lens = []
         for i, (dname, ds) in enumerate(datasets):
+            # old pickled datasets get turned into columns once, here
+            if not isinstance(ds, TrialTable):
+                ds = trials_to_table(ds)
             self.dnames.append(dname)
             self.data.append(ds)
-            # setting context cue for appropriate task
-            x_ctx = np.zeros((args.T, ds[0].t_len))
-            x_ctx[i] = 1
-            self.x_ctxs.append(x_ctx)
-            self.t_lens.append(ds[0].t_len)
+            self.t_lens.append(ds.header['t_len'])
             # cumulative lengths of data, for indexing
             self.max_idxs[i] = self.max_idxs[i-1] + len(ds)
-            # use ds[0] as exemplar to set t_type, L, Z
-            self.t_types.append(ds[0].t_type)
-            self.lzs.append((ds[0].L, ds[0].Z))
+            self.t_types.append(ds.header['t_type'])
+            self.lzs.append((ds.header['L'], ds.header['Z']))
+        # stimulus rows come first, then the context cues
+        self.L = max(lz[0] for lz in self.lzs)
+        self.Z = max(lz[1] for lz in self.lzs)
+        # earlier tasks' trials to mix into batches, in sequential training with --replay_size
+        self.replay = None
 
     def __len__(self):
         return self.max_idxs[-1]
 
+    # up to n of context c's trials, for the replay buffer
+    def context_table(self, c, n, rng):
+        table = self.data[c]
+        return table.take(np.sort(rng.choice(len(table), min(n, len(table)), replace=False)))
+
     def __getitem__(self, idx):
         if isinstance(idx, slice):
-            return [self[ii] for ii in range(len(self))[idx]]
-        # index into the appropriate dataset to get the trial
-        context = self.get_context(idx)
-        # idx variable now references position within dataset
-        if context != 0:
-            idx = idx - self.max_idxs[context-1]
-
-        trial = self.data[context][idx]
-        x = trial.get_x(self.args)
-        x_cts = self.x_ctxs[context]
-        # context comes after the stimulus
-        x = np.concatenate((x, x_cts))
-        y = trial.get_y(self.args)
-
-        trial.context = context
-        trial.dname = self.dnames[context]
-        trial.lz = self.lzs[context]
-        return x, y, trial
+            return self.get_batch(range(len(self))[idx])
+        elif hasattr(idx, '__iter__'):
+            return self.get_batch(idx)
+        x, y, trials = self.get_batch([idx])
+        return x[0].numpy(), y[0].numpy(), trials[0]
 
     def get_context(self, idx):
-        return np.argmax(self.max_idxs > idx)
+        return np.searchsorted(self.max_idxs, idx, side='right')
+
+    # renders trials idxs into x [B, L+T, t_len] and y [B, Z, t_len]
+    # trials are grouped by context so each context renders into a contiguous block
+    def get_batch(self, idxs):
+        start = time.perf_counter()
+        idxs = np.asarray(idxs, dtype=int)
+        contexts = self.get_context(idxs)
+        order = np.argsort(contexts, kind='stable')
+        idxs, contexts = idxs[order], contexts[order]
+
+        tables = []
+        bounds = np.searchsorted(contexts, np.arange(len(self.data) + 1))
+        for c in range(len(self.data)):
+            lo, hi = bounds[c], bounds[c+1]
+            if lo == hi:
+                continue
+            # idx variable now references position within dataset
+            offset = self.max_idxs[c-1] if c != 0 else 0
+            tables.append((c, self.data[c].take(idxs[lo:hi] - offset)))
+
+        if self.replay is not None:
+            tables = self.replay.mix(tables, len(idxs), np.random)
+        x, y, trials = render_contexts(self, tables)
+        trials.data_time = time.perf_counter() - start
+        return x, y, trials
+
+
+# renders [(context, table), ...], in context order, into a single x and y
+# dset is the TrialDataset or TrialStream the tables come from
+def render_contexts(dset, tables, rng=np.random):
+    n = sum(len(table) for c, table in tables)
+    max_len = max(dset.t_lens[c] for c, table in tables)
+    x = torch.zeros((n, dset.L + dset.args.T, max_len))
+    y = torch.zeros((n, dset.Z, max_len))
+    # numpy views of the same memory, for the renderers to write into
+    x_np, y_np = x.numpy(), y.numpy()
+
+    groups = []
+    lo = 0
+    for c, table in tables:
+        hi = lo + len(table)
+        render_table(table, dset.args, x_np[lo:hi], y_np[lo:hi], rng=rng)
+        # context cue comes after the stimulus
+        x_np[lo:hi, dset.L + c, :dset.t_lens[c]] = 1
+        groups.append((lo, table, c))
+        lo = hi
+
+    return x, y, TrialBatch(groups, dset.dnames, dset.lzs)
+
+
+# endless stream of fresh batches, sampled on the fly from dataset configs (datasets/configs/*.json)
+# configs should be in form [(dname, config), ...]. contexts picks which of them to draw trials from
+# every DataLoader worker gets its own generator, spawned from seed
+class TrialStream(IterableDataset):
+    def __init__(self, configs, args, batch_size, seed, contexts=None):
+        self.args = args
+        self.batch_size = batch_size
+        self.seed = seed
+
+        self.dnames = [dname for dname, config in configs]
+        self.configs = [config for dname, config in configs]
+        self.t_types = [config.t_type for config in self.configs]
+        self.t_lens = [config.t_len for config in self.configs]
+        self.lzs = [(config.L, config.Z) for config in self.configs]
+        self.L = max(lz[0] for lz in self.lzs)
+        self.Z = max(lz[1] for lz in self.lzs)
+        if contexts is None:
+            contexts = range(len(configs))
+        self.contexts = list(contexts)
+        self.replay = None
+
+    def context_table(self, c, n, rng):
+        from tasks import sample_trials
+        return sample_trials(self.configs[c], n, rng)
+
+    def __iter__(self):
+        info = get_worker_info()
+        if info is None:
+            w_id, n_workers = 0, 1
+        else:
+            w_id, n_workers = info.id, info.num_workers
+        seed_seq = np.random.SeedSequence(self.seed).spawn(n_workers)[w_id]
+        rng = np.random.default_rng(seed_seq)
+        while True:
+            yield self.sample_batch(rng)
+
+    def sample_batch(self, rng, n=None):
+        # only here so that helpers.py can be used without tasks.py
+        from tasks import sample_trials
+        start = time.perf_counter()
+        if n is None:
+            n = self.batch_size
+        contexts = rng.choice(self.contexts, n)
+        tables = []
+        for c in sorted(set(contexts)):
+            tables.append((c, sample_trials(self.configs[c], np.sum(contexts == c), rng)))
+        if self.replay is not None:
+            tables = self.replay.mix(tables, n, rng)
+        x, y, trials = render_contexts(self, tables, rng=rng)
+        trials.data_time = time.perf_counter() - start
+        return x, y, trials
+
+
+# dataset config with the defaults that sampling needs filled in
+def load_stream_config(path):
+    from tasks import sample_trials
+    config = load_args(path)
+    for k in ['intervals', 'angles']:
+        if not hasattr(config, k):
+            setattr(config, k, None)
+    # older configs don't have L and Z, so get them from an exemplar trial
+    if not hasattr(config, 'L'):
+        header = sample_trials(config, 1, np.random.default_rng(0)).header
+        config.L = header['L']
+        config.Z = header['Z']
+    return config
+
+
+# rehearsal for sequential training (--replay_size). keeps up to size trials of the tasks trained so
+# far, as TrialTable rows (the task parameters, not rendered inputs), split evenly between the tasks,
+# so it takes the same memory however many there are. a ratio of every batch is swapped for
+# replayed trials, which render along with the fresh ones
+class ReplayBuffer:
+    def __init__(self, size, ratio):
+        self.size = size
+        self.ratio = ratio
+        self.tables = {}
+
+    # after training on context c of dset
+    def add_task(self, dset, c, rng):
+        share = self.size // (len(self.tables) + 1)
+        self.tables[c] = dset.context_table(c, share, rng)
+        for k, table in self.tables.items():
+            if len(table) > share:
+                self.tables[k] = table.take(np.sort(rng.choice(len(table), share, replace=False)))
+
+    # tables of a fresh batch of n trials, with some of them replaced by replayed ones
+    def mix(self, tables, n, rng):
+        n_replay = int(round(self.ratio * n))
+        if len(self.tables) == 0 or n_replay == 0:
+            return tables
+        # fresh trials are in a random order already, so the ones at the end can go
+        fresh = []
+        left = n - n_replay
+        for c, table in tables:
+            if left > 0:
+                fresh.append((c, table[:left]))
+            left -= len(table)
+        contexts = sorted(self.tables)
+        picks = rng.choice(len(contexts), n_replay)
+        replay = []
+        for i, c in enumerate(contexts):
+            n_c = int(np.sum(picks == i))
+            if n_c > 0:
+                table = self.tables[c]
+                replay.append((c, table.take(rng.choice(len(table), n_c))))
+        return fresh + replay
+
+    # as tensors, so it saves with the rest of the training state
+    def state_dict(self):
+        return {c: (t.header, {k: torch.from_numpy(v) for k, v in t.columns.items()}) for c, t in self.tables.items()}
+
+    def load_state_dict(self, state):
+        self.tables = {c: TrialTable(header, {k: v.cpu().numpy() for k, v in cols.items()}) for c, (header, cols) in state.items()}
+
+
+# the trials of a rendered batch, made into individual trial objects only when asked for
+class TrialBatch:
+    def __init__(self, groups, dnames, lzs):
+        self.groups = groups
+        self.dnames = dnames
+        self.lzs = lzs
+        self.n = sum(len(g[1]) for g in groups)
+        self.cache = {}
+        # seconds it took to make this batch, wherever that happened
+        self.data_time = 0
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return (self[j] for j in range(self.n))
+
+    def __getitem__(self, j):
+        if isinstance(j, slice):
+            return [self[jj] for jj in range(self.n)[j]]
+        if j < 0:
+            j += self.n
+        if j not in self.cache:
+            if j < 0 or j >= self.n:
+                raise IndexError
+            for lo, table, context in reversed(self.groups):
+                if j >= lo:
+                    break
+            trial = table[j - lo]
+            trial.context = context
+            trial.dname = self.dnames[context]
+            trial.lz = self.lzs[context]
+            self.cache[j] = trial
+        return self.cache[j]
 
 
 # turns data samples into stuff that can be run through network
@@ -99,12 +300,412 @@ def collater(samples):
     ys = torch.as_tensor(np.stack(ys_pad), dtype=torch.float)
     return xs, ys, trials
 
+# batches come out of TrialDataset already rendered and collated
+def batch_collater(batch):
+    return batch
+
+# DataLoader seeds python's random and torch in each worker, but before torch 1.9 it doesn't seed numpy,
+# so every worker would draw the same input noise. torch 1.9 and later seed numpy too, which this
+# only replaces with another per-worker seed
+def seed_worker(worker_id):
+    np.random.seed(torch.initial_seed() % 2**32)
+
+# fixed evaluation batches for a test loader, in batches of size trials: n trials picked once with a fixed
+# seed, or every trial it can give if n is None. streams never end, so they always give n trials
+# (or one batch) from the start of the stream
+def render_eval_set(loader, size, n=None):
+    dset = loader.dataset
+    if isinstance(dset, TrialStream):
+        rng = np.random.default_rng(np.random.SeedSequence(dset.seed))
+        n = size if n is None else n
+        return [dset.sample_batch(rng, min(size, n - i)) for i in range(0, n, size)]
+    # indices of the SubsetRandomSampler inside the loader's BatchSampler
+    idxs = list(loader.sampler.sampler.indices)
+    if n is not None and n < len(idxs):
+        idxs = sorted(np.random.default_rng(0).choice(idxs, n, replace=False).tolist())
+    return [render_rows(dset, idxs[i:i+size]) for i in range(0, len(idxs), size)]
+
+# every batch of several eval sets joined into one, padded to the longest trial, so they can all be
+# tested in one run through the network. not every loss ignores what's past the end of a trial, so
+# batches says where each set's batches ended up and how long they were, to score them as they were
+def join_eval_sets(eval_sets):
+    batches = [b for es in eval_sets for b in es]
+    T = max(x.shape[2] for x, y, trials in batches)
+    x = torch.cat([nn.functional.pad(x, (0, T - x.shape[2])) for x, y, trials in batches])
+    y = torch.cat([nn.functional.pad(y, (0, T - y.shape[2])) for x, y, trials in batches])
+    trials = [t for x, y, tr in batches for t in tr]
+    sets = []
+    lo = 0
+    for es in eval_sets:
+        sets.append([])
+        for b_x, b_y, b_trials in es:
+            sets[-1].append((lo, lo + len(b_x), b_x.shape[2]))
+            lo += len(b_x)
+    return x, y, trials, sets
+
+# caches for processes that do many runs one after the other (python -m sweep warm). None means off
+# datasets loaded so far, as TrialTables
+TABLE_CACHE = None
+# batches rendered so far. only ones without input noise, since those don't depend on the rng
+RENDER_CACHE = None
+
+def table_key(dpath):
+    return (os.path.abspath(dpath), os.path.getmtime(dpath))
+
+# load_dataset, as a TrialTable
+def load_table(dpath):
+    if TABLE_CACHE is not None and table_key(dpath) in TABLE_CACHE:
+        return TABLE_CACHE[table_key(dpath)]
+    dset = load_dataset(dpath)
+    if not isinstance(dset, TrialTable):
+        dset = trials_to_table(dset)
+    if TABLE_CACHE is not None:
+        TABLE_CACHE[table_key(dpath)] = dset
+    return dset
+
+# dset.get_batch, from the cache if the same rows have been rendered before
+def render_rows(dset, idxs):
+    args = dset.args
+    noisy = args.m_noise != 0 or (hasattr(args, 'x_noise') and args.x_noise != 0)
+    if RENDER_CACHE is None or noisy or not hasattr(dset, 'key'):
+        return dset.get_batch(idxs)
+    key = (dset.key, args.T, np.asarray(idxs, dtype=int).tobytes())
+    if key not in RENDER_CACHE:
+        RENDER_CACHE[key] = dset.get_batch(idxs)
+    return RENDER_CACHE[key]
+
+# DataLoader options for the data pipeline, from --n_workers, --prefetch, --pin_memory, --persistent_workers
+# test loaders only ever get asked for a batch at a time, so they don't get workers
+def loader_kwargs(args, test=False):
+    n_workers = args.n_workers if hasattr(args, 'n_workers') and not test else 0
+    kwargs = {
+        'num_workers': n_workers,
+        'pin_memory': hasattr(args, 'pin_memory') and args.pin_memory and torch.cuda.is_available(),
+    }
+    if n_workers > 0:
+        kwargs['worker_init_fn'] = seed_worker
+        kwargs['persistent_workers'] = hasattr(args, 'persistent_workers') and args.persistent_workers
+        if hasattr(args, 'prefetch') and args.prefetch > 0:
+            kwargs['prefetch_factor'] = args.prefetch
+    return kwargs
+
+# workers each get their own copy of the dataset when they start, and persistent ones keep it between
+# epochs. this stops them, so the next pass over the loader starts new ones that see any changes made
+# to the dataset since, like trials added to its replay buffer
+def restart_workers(loader):
+    it = loader._iterator if hasattr(loader, '_iterator') else None
+    if it is not None and hasattr(it, '_shutdown_workers'):
+        it._shutdown_workers()
+    loader._iterator = None
+
+# loader over some of the indices of dset, which gets whole batches of indices at a time
+def create_batch_loader(dset, idxs, batch_size, drop_last, args, test=False):
+    sampler = BatchSampler(SubsetRandomSampler(idxs), batch_size=batch_size, drop_last=drop_last)
+    return DataLoader(dset, batch_size=None, sampler=sampler, collate_fn=batch_collater, **loader_kwargs(args, test))
+
+# loader over a TrialStream. the stream does its own batching
+def create_stream_loader(stream, args, test=False):
+    return DataLoader(stream, batch_size=None, collate_fn=batch_collater, **loader_kwargs(args, test))
+
+
+# runs a loader in a background thread that keeps up to depth batches ready,
+# so that without workers batches still get made while the main thread trains
+class Prefetcher:
+    def __init__(self, loader, depth=2, pin_memory=False):
+        self.loader = loader
+        self.depth = depth
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for x, y, trials in self.loader:
+                    if self.pin_memory:
+                        x, y = x.pin_memory(), y.pin_memory()
+                    if not self.put(q, stop, (x, y, trials)):
+                        return
+            except Exception as e:
+                self.put(q, stop, e)
+                return
+            self.put(q, stop, done)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = q.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # training loop stopped early, so let the thread finish
+            stop.set()
+            thread.join()
+
+    # put that gives up if the consumer has gone away
+    def put(self, q, stop, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+# keeps track of how long the training loop waits for each batch, compared to how long
+# the batches took to make. whatever isn't spent waiting was hidden behind compute
+class DataTimer:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.wait = 0.
+        self.data = 0.
+        self.total = 0.
+        self.last = None
+
+    def wrap(self, loader):
+        it = iter(loader)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    return
+                now = time.perf_counter()
+                if self.last is not None:
+                    self.total += now - self.last
+                self.last = now
+                self.n += 1
+                self.wait += now - start
+                self.data += batch[2].data_time if hasattr(batch[2], 'data_time') else 0
+                yield batch
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+
+    # ms per iteration spent waiting, making data, and overall, plus the share of data time hidden
+    def summary(self):
+        n = max(self.n, 1)
+        wait, data, total = 1000 * self.wait / n, 1000 * self.data / n, 1000 * self.total / n
+        hidden = 1 - min(wait / data, 1) if data > 0 else 0
+        return wait, data, total, hidden
+
+# trainable parameters as views into one flat buffer, and their gradients as views into another,
+# so an optimizer that works on flat vectors (scipy) sets and reads all of them with a single copy.
+# shared puts both buffers in shared memory; other processes can pass them in as data and grad
+# to have their own parameters live in the same memory
+class FlatParams:
+    def __init__(self, params, shared=False, data=None, grad=None):
+        self.params = list(params)
+        n = sum(p.numel() for p in self.params)
+        copy = data is None
+        if data is None:
+            data = torch.zeros(n, dtype=self.params[0].dtype, device=self.params[0].device)
+        if grad is None:
+            grad = torch.zeros_like(data)
+        if shared:
+            data.share_memory_()
+            grad.share_memory_()
+        self.data = data
+        self.grad = grad
+        self.grads = []
+        ind = 0
+        with torch.no_grad():
+            for p in self.params:
+                k = p.numel()
+                if copy:
+                    self.data[ind:ind+k].copy_(p.reshape(-1))
+                p.data = self.data[ind:ind+k].view_as(p)
+                self.grads.append(self.grad[ind:ind+k].view_as(p))
+                p.grad = self.grads[-1]
+                ind += k
+
+    def numpy(self):
+        return self.data.cpu().numpy().astype(np.float64)
+
+    # scipy's float64 vector into the parameters
+    def set(self, v):
+        with torch.no_grad():
+            self.data.copy_(torch.from_numpy(v))
+
+    def zero_grad(self):
+        self.grad.zero_()
+        for p, g in zip(self.params, self.grads):
+            p.grad = g
+
+    # backward accumulates into the views in place. anything that replaced a gradient instead
+    # (like OWM's projections) gets copied back in. returns a new float64 array for scipy to keep
+    def grad_numpy(self):
+        with torch.no_grad():
+            for p, g in zip(self.params, self.grads):
+                if p.grad is not g:
+                    g.copy_(p.grad)
+        return self.grad.cpu().numpy().astype(np.float64)
+
+# save to a temporary file next to the target, then rename over it, so there's always a whole file at path
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+# cpu copy of every tensor in a (possibly nested) dict
+def snapshot(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return OrderedDict((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+# every global random number generator, so training can carry on exactly where it stopped.
+# numpy's state is kept as a tensor so the whole thing loads like any other checkpoint
+def get_rng_states():
+    kind, keys, pos, has_gauss, gauss = np.random.get_state()
+    states = {
+        'torch': torch.get_rng_state(),
+        'numpy': (kind, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, gauss),
+        'python': random.getstate()
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+def set_rng_states(states, numpy=True):
+    torch.set_rng_state(states['torch'].cpu())
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in states['cuda']])
+    if numpy:
+        kind, keys, pos, has_gauss, gauss = states['numpy']
+        np.random.set_state((kind, keys.cpu().numpy().astype(np.uint32), pos, has_gauss, gauss))
+    random.setstate(states['python'])
+
+# saves checkpoints in a background thread, so training doesn't wait on the disk.
+# state dicts are copied when they're handed over, and a save that's still waiting is replaced by a
+# newer one to the same file. at most max_pending saves wait at a time; beyond that save() blocks,
+# and that time is reported as blocked
+class CheckpointWriter:
+    def __init__(self, max_pending=4):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.writing = False
+        self.closed = False
+        self.error = None
+
+        self.n_saved = 0
+        self.n_coalesced = 0
+        self.write_time = 0.
+        self.blocked_time = 0.
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, state_dict, path):
+        state_dict = snapshot(state_dict)
+        with self.cond:
+            self.check()
+            if path in self.pending:
+                self.n_coalesced += 1
+            else:
+                start = time.perf_counter()
+                while len(self.pending) >= self.max_pending and self.error is None:
+                    self.cond.wait()
+                self.blocked_time += time.perf_counter() - start
+                self.check()
+            self.pending[path] = state_dict
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0 and not self.closed:
+                    self.cond.wait()
+                if len(self.pending) == 0:
+                    return
+                path, state_dict = self.pending.popitem(last=False)
+                self.writing = True
+                self.cond.notify_all()
+            start = time.perf_counter()
+            try:
+                atomic_save(state_dict, path)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.writing = False
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.write_time += time.perf_counter() - start
+                self.n_saved += 1
+                self.writing = False
+                self.cond.notify_all()
+
+    # raise whatever went wrong in the thread
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    # wait for everything pending to be written
+    def flush(self):
+        start = time.perf_counter()
+        with self.cond:
+            while (len(self.pending) > 0 or self.writing) and self.error is None:
+                self.cond.wait()
+            self.blocked_time += time.perf_counter() - start
+            self.check()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def summary(self):
+        return f'{self.n_saved} saves ({self.n_coalesced} coalesced), {self.write_time:.1f}s writing, {self.blocked_time:.2f}s blocked'
+
+# same as create_loaders, but datasets are config paths and trials are generated as they're needed
+# train and test streams are seeded differently, and test loaders start from the same trials every time
+def create_stream_loaders(datasets, args, split_test=True, test_size=1, context_filter=[]):
+    configs = []
+    for i, cpath in enumerate(datasets):
+        dname = str(i) + '_' + ':'.join(cpath.split('/')[-1].split('.')[:-1])
+        configs.append((dname, load_stream_config(cpath)))
+    seed = args.seed if hasattr(args, 'seed') and args.seed is not None else 0
+
+    def create_streams(batch_size, stream_id, test=False):
+        if args.sequential:
+            stream = TrialStream(configs, args, batch_size, [seed, stream_id])
+            streams = [TrialStream(configs, args, batch_size, [seed, stream_id, i], contexts=[i]) for i in range(len(configs))]
+            return stream, [create_stream_loader(s, args, test) for s in streams]
+        contexts = [i for i in range(len(configs)) if i not in context_filter]
+        stream = TrialStream(configs, args, batch_size, [seed, stream_id], contexts=contexts)
+        return stream, create_stream_loader(stream, args, test)
+
+    tests = create_streams(test_size, 1, True)
+    if split_test:
+        return create_streams(args.batch_size, 0), tests
+    return tests
+
 # creates datasets and dataloaders
 def create_loaders(datasets, args, split_test=True, test_size=1, context_filter=[]):
+    if hasattr(args, 'stream') and args.stream:
+        return create_stream_loaders(datasets, args, split_test, test_size, context_filter)
     dsets_train = []
     dsets_test = []
     for i, dpath in enumerate(datasets):
-        dset = load_rb(dpath)
+        dset = load_table(dpath)
         # trim and set name of each dataset
         dname = str(i) + '_' + ':'.join(dpath.split('/')[-1].split('.')[:-1])
         if split_test:
@@ -114,34 +715,37 @@ def create_loaders(datasets, args, split_test=True, test_size=1, context_filter=
         else:
             dsets_test.append([dname, dset])
 
-    # creating datasets
+    # creating datasets. keys identify the data in them, for caching renders
+    key = tuple(table_key(dpath) for dpath in datasets)
     test_set = TrialDataset(dsets_test, args)
+    test_set.key = (key, 'test' if split_test else 'all')
     if split_test:
         train_set = TrialDataset(dsets_train, args)
+        train_set.key = (key, 'train')
 
     # TODO: make all this code better
     if args.sequential:
         # helper function for sequential loaders
-        def create_subset_loaders(dset, batch_size, drop_last):
+        def create_subset_loaders(dset, batch_size, drop_last, test=False):
             loaders = []
             max_idxs = dset.max_idxs
             for i in range(len(datasets)):
                 if i == 0:
-                    subset = Subset(dset, range(max_idxs[0]))
+                    subset = range(max_idxs[0])
                 else:
-                    subset = Subset(dset, range(max_idxs[i-1], max_idxs[i]))
-                loader = DataLoader(subset, batch_size=batch_size, shuffle=True, collate_fn=collater, drop_last=drop_last)
+                    subset = range(max_idxs[i-1], max_idxs[i])
+                loader = create_batch_loader(dset, subset, batch_size, drop_last, args, test)
                 loaders.append(loader)
             return loaders
         # create the loaders themselves
-        test_loaders = create_subset_loaders(test_set, test_size, False)
+        test_loaders = create_subset_loaders(test_set, test_size, False, True)
         if split_test:
             train_loaders = create_subset_loaders(train_set, args.batch_size, True)
             return (train_set, train_loaders), (test_set, test_loaders)
         return (test_set, test_loaders)
     # filter out some contexts
     elif len(context_filter) != 0:
-        def create_context_loaders(dset, batch_size, drop_last):
+        def create_context_loaders(dset, batch_size, drop_last, test=False):
             max_idxs = dset.max_idxs
             c_range = []
             for i in range(len(datasets)):
@@ -151,11 +755,10 @@ def create_loaders(datasets, args, split_test=True, test_size=1, context_filter=
                     c_range += list(range(max_idxs[0]))
                 else:
                     c_range += list(range(max_idxs[i-1], max_idxs[i]))
-            subset = Subset(dset, c_range)
-            loader = DataLoader(subset, batch_size=batch_size, shuffle=True, collate_fn=collater, drop_last=drop_last)
+            loader = create_batch_loader(dset, c_range, batch_size, drop_last, args, test)
             return loader
         # create the loaders themselves
-        test_loaders = create_context_loaders(test_set, test_size, False)
+        test_loaders = create_context_loaders(test_set, test_size, False, True)
         if split_test:
             train_loaders = create_context_loaders(train_set, args.batch_size, True)
             return (train_set, train_loaders), (test_set, test_loaders)
@@ -163,9 +766,9 @@ def create_loaders(datasets, args, split_test=True, test_size=1, context_filter=
         
     else:
         # otherwise it's quite simple, create a single dataset and loader
-        test_loader = DataLoader(test_set, batch_size=test_size, shuffle=True, collate_fn=collater, drop_last=False)
+        test_loader = create_batch_loader(test_set, range(len(test_set)), test_size, False, args, True)
         if split_test:
-            train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, collate_fn=collater, drop_last=True)
+            train_loader = create_batch_loader(train_set, range(len(train_set)), args.batch_size, True, args)
             return (train_set, train_loader), (test_set, test_loader)
         return (test_set, test_loader)
         
@@ -238,6 +841,52 @@ def get_criteria(args):
         raise NotImplementedError
     return criteria
 
+# closed-form readout for variable projection training (--varpro). the output is linear in M_ro given
+# the features going into it, so the best M_ro for a batch is a ridge regression over every timestep
+# the loss counts. with decay > 0 the regression uses a running sum of earlier batches' statistics too
+class RidgeReadout:
+    def __init__(self, args):
+        self.ridge = args.ridge
+        self.decay = args.varpro_decay
+        self.bias = args.ff_bias
+        self.A = None
+        self.B = None
+
+    # h is [batch, D2, time], y is [batch, Z, time], t_lens is how much of each trial counts
+    def fit(self, M_ro, h, y, t_lens):
+        mask = torch.arange(h.shape[2], device=h.device)[None, :] < t_lens[:, None]
+        H = h.detach().permute(0, 2, 1)[mask]
+        Y = y.permute(0, 2, 1)[mask]
+        if self.bias:
+            H = torch.cat((H, torch.ones((len(H), 1), device=H.device)), dim=1)
+        A = H.t() @ H
+        B = H.t() @ Y
+        if self.A is not None and self.decay > 0:
+            A = A + self.decay * self.A
+            B = B + self.decay * self.B
+        self.A, self.B = A, B
+
+        # the bias isn't shrunk
+        reg = self.ridge * torch.ones(len(A), device=A.device)
+        if self.bias:
+            reg[-1] = 0
+        W = torch.cholesky_solve(B, cholesky(A + torch.diag(reg)))
+        with torch.no_grad():
+            M_ro.weight.copy_(W[:h.shape[1]].t())
+            if self.bias:
+                M_ro.bias.copy_(W[-1])
+
+    # the running statistics, for resuming
+    def state_dict(self):
+        return {'A': self.A, 'B': self.B}
+
+    def load_state_dict(self, state):
+        self.A = state['A']
+        self.B = state['B']
+
+# torch.linalg only has it from 1.8
+cholesky = torch.linalg.cholesky if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'cholesky') else torch.cholesky
+
 def get_activation(name):
     if name == 'exp':
         fn = torch.exp
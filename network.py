@@ -9,6 +9,9 @@ import pdb
 import random
 import copy
 import sys
+import hashlib
+import json
+import shutil
 
 from utils import Bunch, load_rb, update_args
 from helpers import get_activation
@@ -66,6 +69,13 @@ class M2Net(nn.Module):
         self.reset()
 
     def _init_vars(self):
+        ckpt = None
+        if self.args.model_path is not None:
+            ckpt = torch.load(self.args.model_path, map_location='cpu')
+            if is_compact(ckpt):
+                # build the same reservoir the checkpoint was trained with
+                for k, v in ckpt['reservoir'].items():
+                    setattr(self.args, k, v)
         with TorchSeed(self.args.network_seed):
             D1 = self.args.D1 if self.args.D1 != 0 else self.args.N
             D2 = self.args.D2 if self.args.D2 != 0 else self.args.N
@@ -81,8 +91,19 @@ class M2Net(nn.Module):
         if self.args.M_path is not None:
             M_params = torch.load(self.args.M_path)
             # TODO load M_params
-        if self.args.model_path is not None:
-            self.load_state_dict(torch.load(self.args.model_path))
+        if ckpt is not None:
+            self.load_checkpoint(ckpt)
+
+    def load_checkpoint(self, ckpt):
+        if not is_compact(ckpt):
+            self.load_state_dict(ckpt)
+            return
+        # everything the checkpoint left out has to come out exactly as it was
+        state = self.state_dict()
+        frozen = {k: v for k, v in state.items() if k not in ckpt['state_dict']}
+        if tensor_hash(frozen) != ckpt['reservoir_hash']:
+            raise ValueError('rebuilt reservoir doesn\'t match the one the checkpoint was trained with')
+        self.load_state_dict(ckpt['state_dict'], strict=False)
 
     def add_task(self):
         M = self.M_u.weight.data
@@ -117,6 +138,10 @@ class M2Net(nn.Module):
         if self.args.use_reservoir:
             self.reservoir.reset(res_state=res_state, device=device)
 
+# reservoirs built so far, by reservoir_spec, for processes that do many runs one
+# after the other (python -m sweep warm). None means off
+RESERVOIRS = None
+
 class M2Reservoir(nn.Module):
     def __init__(self, args=DEFAULT_ARGS):
         super().__init__()
@@ -133,33 +158,110 @@ class M2Reservoir(nn.Module):
         # use second set of dynamics equations as in jazayeri papers
         self.dynamics_mode = 0
 
+        # hashes of the frozen weights for compact checkpoints, by which weights are frozen
+        self.frozen_hashes = {}
+
         self._init_vars()
         self.reset()
 
     def _init_vars(self):
         if self.args.res_path is not None:
             self.load_state_dict(torch.load(self.args.res_path))
+            self.add_spec_fixed_points()
+            return
+        key = None
+        if RESERVOIRS is not None:
+            key = json.dumps(reservoir_spec(self.args), sort_keys=True)
+            if key in RESERVOIRS:
+                # every run gets its own copy, in case it trains the reservoir
+                self._init_from(lambda name: RESERVOIRS[key][name].clone() if name in RESERVOIRS[key] else None)
+                return
+        if hasattr(self.args, 'res_cache') and self.args.res_cache is not None:
+            self._init_cached(self.args.res_cache)
         else:
-            with TorchSeed(self.args.res_seed):
-                if self.args.D1 == 0:
-                    # go straight from the input to the network
-                    self.W_u = nn.Identity()
+            self._init_random()
+            self.add_spec_fixed_points()
+        if key is not None:
+            RESERVOIRS[key] = {k: v.clone() for k, v in self.state_dict().items()}
+
+    # fixed points are part of the reservoir, wherever its weights came from
+    def add_spec_fixed_points(self):
+        spec = reservoir_spec(self.args)
+        if spec['fixed_pts'] > 0:
+            self.add_fixed_points(spec['fixed_pts'])
+
+    # the frozen weights never change once they're built, so each checkpoint doesn't have to hash them
+    # again. names are state_dict keys of the whole network, starting with reservoir.
+    def frozen_hash(self, names):
+        key = tuple(sorted(names))
+        if key not in self.frozen_hashes:
+            state = self.state_dict(prefix='reservoir.')
+            self.frozen_hashes[key] = tensor_hash({k: state[k] for k in key})
+        return self.frozen_hashes[key]
+
+    # reservoirs are stored in the cache folder under a hash of reservoir_spec, one .npy per weight.
+    # they're memory-mapped copy-on-write, so processes using the same reservoir share its pages
+    def _init_cached(self, cache_dir):
+        spec = reservoir_spec(self.args)
+        key = hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+        path = os.path.join(cache_dir, key)
+        if not os.path.isdir(path):
+            self._init_random()
+            self.add_spec_fixed_points()
+            # written to a temporary folder first, so other processes never see half a reservoir
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            os.makedirs(tmp_path, exist_ok=True)
+            for k, v in self.state_dict().items():
+                np.save(os.path.join(tmp_path, f'{k}.npy'), v.numpy())
+            with open(os.path.join(tmp_path, 'spec.json'), 'w') as f:
+                json.dump(spec, f)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # someone else got there first
+                shutil.rmtree(tmp_path)
+
+        def cached(name):
+            fpath = os.path.join(path, f'{name}.npy')
+            if not os.path.exists(fpath):
+                return None
+            return torch.from_numpy(np.load(fpath, mmap_mode='c'))
+
+        self._init_from(cached)
+
+    # same modules as _init_random, with weights from get(name) instead of generating them. the seed is
+    # only there so that building them doesn't touch the global rng
+    def _init_from(self, get):
+        with TorchSeed(self.args.res_seed):
+            for name in ['W_u', 'J', 'W_ro']:
+                weight = get(f'{name}.weight')
+                if weight is None:
+                    setattr(self, name, nn.Identity())
                 else:
-                    # use representation layer in between as division bw trained / untrained parts
-                    self.W_u = nn.Linear(self.args.D1, self.args.N, bias=False)
-                    torch.nn.init.normal_(self.W_u.weight.data, std=self.args.res_init_g / np.sqrt(self.args.D1))
+                    setattr(self, name, linear_from(weight, get(f'{name}.bias')))
 
-                # recurrent weights
-                self.J = nn.Linear(self.args.N, self.args.N, bias=self.args.res_bias)
-                torch.nn.init.normal_(self.J.weight.data, std=self.args.res_init_g / np.sqrt(self.args.N))
+    def _init_random(self):
+        with TorchSeed(self.args.res_seed):
+            if self.args.D1 == 0:
+                # go straight from the input to the network
+                self.W_u = nn.Identity()
+            else:
+                # use representation layer in between as division bw trained / untrained parts
+                self.W_u = nn.Linear(self.args.D1, self.args.N, bias=False)
+                torch.nn.init.normal_(self.W_u.weight.data, std=self.args.res_init_g / np.sqrt(self.args.D1))
 
-                if self.args.D2 == 0:
-                    # go straight to output
-                    self.W_ro = nn.Identity()
-                else:
-                    # use low-D representation layer bw output
-                    self.W_ro = nn.Linear(self.args.N, self.args.D2, bias=self.args.res_bias)
-                    torch.nn.init.normal_(self.W_ro.weight.data, std=self.args.res_init_g / np.sqrt(self.args.D2))
+            # recurrent weights
+            self.J = nn.Linear(self.args.N, self.args.N, bias=self.args.res_bias)
+            torch.nn.init.normal_(self.J.weight.data, std=self.args.res_init_g / np.sqrt(self.args.N))
+
+            if self.args.D2 == 0:
+                # go straight to output
+                self.W_ro = nn.Identity()
+            else:
+                # use low-D representation layer bw output
+                self.W_ro = nn.Linear(self.args.N, self.args.D2, bias=self.args.res_bias)
+                torch.nn.init.normal_(self.W_ro.weight.data, std=self.args.res_init_g / np.sqrt(self.args.D2))
 
     # add designated fixed points using hopfield network
     def add_fixed_points(self, n_patterns):
@@ -248,6 +350,55 @@ class M2Reservoir(nn.Module):
         if burn_in:
             self.burn_in(self.args.res_burn_steps)
 
+# compact checkpoints store the trained parameters, plus what's needed to rebuild the frozen reservoir
+# and a hash to check the rebuilt one against, instead of the reservoir weights themselves
+def is_compact(ckpt):
+    return 'reservoir_hash' in ckpt
+
+def tensor_hash(tensors):
+    h = hashlib.sha1()
+    for k in sorted(tensors.keys()):
+        h.update(k.encode())
+        h.update(tensors[k].detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+# what M2Reservoir builds its weights from
+def reservoir_spec(args):
+    fixed_pts = args.fixed_pts if hasattr(args, 'fixed_pts') and args.fixed_pts is not None else 0
+    return {
+        'res_seed': args.res_seed,
+        'N': args.N,
+        'D1': args.D1,
+        'D2': args.D2,
+        'res_init_g': args.res_init_g,
+        'res_bias': args.res_bias,
+        'fixed_pts': fixed_pts,
+        'fixed_beta': args.fixed_beta if fixed_pts > 0 else None
+    }
+
+# state dict with the frozen reservoir weights replaced by reservoir_spec. keep are the trained parameter names
+def compact_state_dict(net, keep):
+    state = net.state_dict()
+    frozen = {k: v for k, v in state.items() if k.startswith('reservoir.') and k not in keep}
+    # a reservoir loaded from a file can't be rebuilt from its seed
+    if net.args.res_path is not None or len(frozen) == 0:
+        return state
+    return {
+        'state_dict': {k: v for k, v in state.items() if k not in frozen},
+        'reservoir': reservoir_spec(net.reservoir.args),
+        'reservoir_hash': net.reservoir.frozen_hash(frozen.keys())
+    }
+
+# nn.Linear around existing weights, skipping the default init
+def linear_from(weight, bias=None):
+    layer = nn.Linear(1, 1, bias=bias is not None)
+    layer.in_features = weight.shape[1]
+    layer.out_features = weight.shape[0]
+    layer.weight = nn.Parameter(weight)
+    if bias is not None:
+        layer.bias = nn.Parameter(bias)
+    return layer
+
 # creates reservoir with embedded hopfield patterns
 def hopfield_reservoir(N, g, patterns, beta):
     W = torch.zeros((N, N))
@@ -0,0 +1,70 @@
+import torch
+
+import pdb
+
+from helpers import cholesky
+
+# orthogonal weight modification for sequential training (--owm). while a task trains, the correlations
+# of everything going in and out of M_u and M_ro are summed over every batch it sees. when it's done,
+# they're averaged into the correlations of the tasks before it, and the projectors
+# P = (S / alpha + I)^-1 are kept as cholesky factors, never as inverses.
+# gradients of later tasks are then projected away from what the earlier ones used:
+#   M_u:  P_u @ grad @ P_s        M_ro: P_z @ grad @ P_v
+# where s is the network input, u the output of M_u, v the input to M_ro, and z the output
+class OWM:
+    def __init__(self, alpha=1e-3):
+        self.alpha = alpha
+        self.n_tasks = 0
+        # correlations of the finished tasks, and running sums for the one being trained
+        self.S = {}
+        self.sums = {}
+        self.n = 0
+        # cholesky factors of P^-1
+        self.L = {}
+
+    # states are [batch, dim, time], like the ins, us, vs and outs a training iteration gives back
+    def accumulate(self, states):
+        with torch.no_grad():
+            for k, v in states.items():
+                corr = torch.einsum('ijk,ilk->jl', v, v)
+                self.sums[k] = self.sums[k] + corr if k in self.sums else corr
+            self.n += v.shape[0] * v.shape[2]
+
+    def end_task(self):
+        for k, v in self.sums.items():
+            S_new = v / self.n
+            S = (self.S[k] * self.n_tasks + S_new) / (self.n_tasks + 1) if k in self.S else S_new
+            self.S[k] = S
+            self.L[k] = cholesky(S / self.alpha + torch.eye(len(S), device=S.device))
+        self.n_tasks += 1
+        self.sums = {}
+        self.n = 0
+
+    # P @ A for each of the projectors, by solving instead of multiplying by an inverse
+    def P(self, k, A):
+        return torch.cholesky_solve(A, self.L[k])
+
+    # both sides of M_u and M_ro's gradients in one go. the bias goes along as an extra column,
+    # which only gets the left projection
+    def project(self, net):
+        if self.n_tasks == 0:
+            return
+        with torch.no_grad():
+            for layer, left, right in [(net.M_u, 'u', 's'), (net.M_ro, 'z', 'v')]:
+                G = self.P(right, layer.weight.grad.t()).t()
+                if layer.bias is not None:
+                    G = torch.cat((G, layer.bias.grad[:, None]), dim=1)
+                G = self.P(left, G)
+                layer.weight.grad.copy_(G[:, :layer.weight.shape[1]])
+                if layer.bias is not None:
+                    layer.bias.grad.copy_(G[:, -1])
+
+    def state_dict(self):
+        return {'n_tasks': self.n_tasks, 'S': self.S, 'sums': self.sums, 'n': self.n, 'L': self.L}
+
+    def load_state_dict(self, state):
+        self.n_tasks = state['n_tasks']
+        self.S = state['S']
+        self.sums = state['sums']
+        self.n = state['n']
+        self.L = state['L']
@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import queue
+import pdb
+
+from network import M2Net
+from helpers import get_criteria, FlatParams
+
+# the full-batch loss and gradient for scipy's L-BFGS, split across worker processes.
+# every worker has its own copy of the network, whose trained parameters live in the same shared
+# memory buffer as the trainer's, so scipy's vector only gets copied in once. each one runs its
+# share of the trials into its own shared gradient buffer, and the trainer adds them up
+
+# summed loss over a batch of trials, same as Trainer.run_trial with full BPTT
+def batch_loss(net, args, criteria, x, y, trials):
+    net.reset(args.res_x_init)
+    outs = torch.stack([net(x[:,:,j]) for j in range(x.shape[2])], dim=2)
+    loss = 0.
+    for c in criteria:
+        loss += c(outs, y, i=trials, t_ix=0)
+    return loss
+
+def closure_worker(args, state_dict, names, data, grad, x, y, trials, requests, results, n_threads):
+    torch.set_num_threads(n_threads)
+    net = M2Net(args)
+    net.load_state_dict(state_dict)
+    params = dict(net.named_parameters())
+    flat = FlatParams([params[k] for k in names], data=data, grad=grad)
+    criteria = get_criteria(args)
+
+    while True:
+        if requests.get() is None:
+            break
+        flat.zero_grad()
+        loss = batch_loss(net, args, criteria, x, y, trials)
+        loss.backward()
+        flat.grad_numpy()
+        results.put(loss.item())
+
+
+class ParallelClosure:
+    def __init__(self, net, names, flat, xs, ys, trials, args, n_procs):
+        ctx = mp.get_context('spawn')
+        self.flat = flat
+        self.n = len(xs)
+        state_dict = {k: v.cpu() for k, v in net.state_dict().items()}
+        # each worker gets a contiguous chunk of the trials and an even share of the cores
+        bounds = np.linspace(0, self.n, n_procs + 1).astype(int)
+        n_threads = max(1, torch.get_num_threads() // n_procs)
+        self.grads = torch.zeros((n_procs, len(flat.data))).share_memory_()
+        self.results = ctx.Queue()
+        self.requests = []
+        self.procs = []
+        for i in range(n_procs):
+            lo, hi = bounds[i], bounds[i+1]
+            self.requests.append(ctx.Queue())
+            self.procs.append(ctx.Process(
+                target=closure_worker,
+                args=(args, state_dict, names, flat.data, self.grads[i], xs[lo:hi].cpu(), ys[lo:hi].cpu(),
+                    trials[lo:hi], self.requests[i], self.results, n_threads),
+                daemon=True
+            ))
+            self.procs[-1].start()
+
+    def get(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                for p in self.procs:
+                    if not p.is_alive():
+                        raise RuntimeError(f'L-BFGS worker died with exit code {p.exitcode}')
+
+    # same as the in-process closure: mean loss over the trials, and the gradient of the summed loss
+    def __call__(self, v):
+        self.flat.set(v)
+        for q in self.requests:
+            q.put(True)
+        total_loss = sum(self.get() for q in self.requests)
+        return total_loss / self.n, self.grads.sum(dim=0).numpy().astype(np.float64)
+
+    def close(self):
+        for q in self.requests:
+            q.put(None)
+        for p in self.procs:
+            p.join()
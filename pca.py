@@ -10,14 +10,18 @@ import sys
 import os
 import pdb
 
-from testers import get_states, load_model_path
-from helpers import create_loaders
+from testers import load_model_path
 from utils import get_config
+from helpers import cholesky
+from states import get_recording
 
 from tasks import *
 
 cspaces = [cm.spring, cm.summer, cm.autumn, cm.winter]
 
+# plots in the first 3 principal components
+RANK = 3
+
 def main(args):
     config = get_config(args.model, to_bunch=True)
     net = load_model_path(args.model, config)
@@ -25,27 +29,34 @@ def main(args):
     if len(args.dataset) == 0:
         args.dataset = config.dataset
 
-    n_reps = 100
     # don't show these contexts
     context_filter = []
 
-    _, loader = create_loaders(args.dataset, config, split_test=False, test_size=n_reps, context_filter=context_filter)
-    x, y, trials = next(iter(loader))
-    A = get_states(net, x)
-
-    t_type = type(trials[0])
-    if t_type == RSG:
-        pca_rsg(args, A, trials, n_reps)
-    elif t_type in [DelayProAnti, MemoryProAnti]:
-        pca_dmpa(args, A, trials, n_reps)
-
-
-def pca_rsg(args, A_uncut, trials, n_reps):
-
-    setting = 'both'
-
+    # the states are recorded to disk once, a batch at a time, and the principal components are found
+    # going through them chunk by chunk, so that only the sketch is kept. then they're projected
+    recording = get_recording(net, config, args.dataset, args.n_trials, args.batch_size, args.dtype, args.states_dir, context_filter)
+    spca = None
+    for A, trials in recording.chunks():
+        if spca is None:
+            spca = StreamingPCA(A.shape[-1], args.sketch)
+            crop = crop_rsg if trials[0].kind == 'RSG' else crop_dmpa
+        spca.partial_fit(torch.cat(crop(A, trials)))
+
+    A_proj = []
+    all_trials = []
+    for A, trials in recording.chunks():
+        A_proj += [spca.transform(a, RANK).float() for a in crop(A, trials)]
+        all_trials += trials
+
+    t_type = all_trials[0].kind
+    if t_type == 'RSG':
+        pca_rsg(args, A_proj, all_trials)
+    elif t_type in ['DelayProAnti', 'MemoryProAnti']:
+        pca_dmpa(args, A_proj, all_trials)
+
+def crop_rsg(A_uncut, trials, setting='both'):
     As = []
-    for idx in range(n_reps):
+    for idx in range(len(trials)):
         t_ready, t_set, t_go = trials[idx].rsg
         if setting == 'estimation':
             As.append(A_uncut[idx,t_ready:t_set])
@@ -53,8 +64,10 @@ def pca_rsg(args, A_uncut, trials, n_reps):
             As.append(A_uncut[idx,t_set:t_go])
         elif setting == 'both':
             As.append(A_uncut[idx,t_ready:t_go])
+    return As
 
-    A_proj = pca(As, 3)
+def pca_rsg(args, A_proj, trials, setting='both'):
+    n_reps = len(trials)
 
     n_contexts = len(args.dataset)
     interval_groups = [{} for i in range(n_contexts)]
@@ -100,33 +113,32 @@ def pca_rsg(args, A_uncut, trials, n_reps):
 
     plt.show()
 
-def pca_dmpa(args, A_uncut, trials, n_reps):
-
-    setting = 'nofix'
-
+def crop_dmpa(A_uncut, trials, setting='nofix'):
     As = []
-    for idx in range(n_reps):
-        t_type = type(trials[idx])
+    for idx in range(len(trials)):
+        t_type = trials[idx].kind
         fix = trials[idx].fix
         stim = trials[idx].stim    
-        if t_type is MemoryProAnti:
+        if t_type == 'MemoryProAnti':
             memory = trials[idx].memory
         if setting == 'all':
             As.append(A_uncut[idx])
         elif setting == 'nofix':
             As.append(A_uncut[idx][fix:])
         elif setting == 'preparation':
-            if t_type is DelayProAnti:
+            if t_type == 'DelayProAnti':
                 As.append(A_uncut[idx,fix:stim])
             else:
                 As.append(A_uncut[idx,fix:memory])
         elif setting == 'movement':
-            if t_type is DelayProAnti:
+            if t_type == 'DelayProAnti':
                 As.append(A_uncut[idx,stim:])
             else:
                 As.append(A_uncut[idx,memory:])
+    return As
 
-    A_proj = pca(As, 3)
+def pca_dmpa(args, A_proj, trials, setting='nofix'):
+    n_reps = len(trials)
 
     n_contexts = len(args.dataset)
     stimuli_groups = [{} for i in range(n_contexts)]
@@ -169,6 +181,69 @@ def pca_dmpa(args, A_uncut, trials, n_reps):
     plt.show()
 
 
+# principal components of states that come a batch at a time, without keeping them. the covariance
+# is only seen through C @ omega for a fixed random orthonormal omega [dim, sketch], which is summed
+# over batches along with the mean. the top eigenvectors then come from the nystrom approximation
+# C ~ Y (omega^T Y)^-1 Y^T (tropp et al 2017), so memory is dim * sketch however many states go in.
+# the sketch should be a fair bit bigger than the rank that's wanted
+class StreamingPCA:
+    def __init__(self, dim, sketch=50, seed=0):
+        self.sketch = min(sketch, dim)
+        g = torch.Generator().manual_seed(seed)
+        self.omega = qr(torch.randn(dim, self.sketch, generator=g, dtype=torch.float64))[0]
+        self.n = 0
+        self.sum = torch.zeros(dim, dtype=torch.float64)
+        self.Y = torch.zeros(dim, self.sketch, dtype=torch.float64)
+        self.V = None
+
+    # A is [n, dim]
+    def partial_fit(self, A):
+        A = A.reshape(-1, A.shape[-1]).double()
+        self.n += len(A)
+        self.sum += A.sum(dim=0)
+        self.Y += A.t() @ (A @ self.omega)
+        self.V = None
+
+    @property
+    def mean(self):
+        return self.sum / self.n
+
+    # principal directions [dim, sketch] and the variance along each, biggest first
+    def components(self):
+        if self.V is None:
+            # centering, with C = sum (a - mean)(a - mean)^T / n
+            mean = self.mean
+            Y = (self.Y - self.n * mean[:, None] * (mean @ self.omega)[None, :]) / self.n
+            # small shift to keep the cholesky stable, taken back off the eigenvalues
+            nu = 1e-10 * Y.norm()
+            Y = Y + nu * self.omega
+            B = self.omega.t() @ Y
+            L = cholesky((B + B.t()) / 2)
+            E = solve_triangular(L, Y.t()).t()
+            U, S = svd(E)[:2]
+            self.V = U
+            self.var = (S ** 2 - nu).clamp(min=0)
+        return self.V, self.var
+
+    # [..., dim] to [..., rank], centered
+    def transform(self, A, rank):
+        V = self.components()[0][:, :rank]
+        return (A.double() - self.mean) @ V
+
+# torch.linalg only has these from 1.8
+qr = torch.linalg.qr if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'qr') else torch.qr
+
+def solve_triangular(L, B):
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'solve_triangular'):
+        return torch.linalg.solve_triangular(L, B, upper=False)
+    return torch.triangular_solve(B, L, upper=False)[0]
+
+def svd(A):
+    if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'svd'):
+        return torch.linalg.svd(A, full_matrices=False)
+    U, S, V = torch.svd(A)
+    return U, S, V.t()
+
 # As should be either [T, D] or [[T, D], ...] shaped where
 # outer (optional) listing
 # T is timesteps
@@ -197,6 +272,11 @@ if __name__ == '__main__':
     ap = argparse.ArgumentParser()
     ap.add_argument('model', type=str)
     ap.add_argument('-d', '--dataset', type=str, nargs='+', default=[])
+    ap.add_argument('-n', '--n_trials', type=int, default=100)
+    ap.add_argument('-b', '--batch_size', type=int, default=100, help='trials simulated at a time')
+    ap.add_argument('--sketch', type=int, default=50, help='size of the pca sketch')
+    ap.add_argument('--dtype', default='float32', choices=['float16', 'float32'], help='precision of recorded states')
+    ap.add_argument('--states_dir', default=None, help='where state recordings go; next to the model by default')
     args = ap.parse_args()
 
     main(args)
\ No newline at end of file
@@ -66,7 +66,7 @@ if not args.no_plot:
         ax.spines['left'].set_visible(False)
         ax.spines['bottom'].set_visible(False)
         
-        if type(trial) in [DelayProAnti, MemoryProAnti]:
+        if trial.kind in ['DelayProAnti', 'MemoryProAnti']:
             ax.plot(xr, x[0], color='grey', lw=1, ls='--', alpha=.4)
             ax.plot(xr, x[1], color='salmon', lw=1, ls='--', alpha=.4)
             ax.plot(xr, x[2], color='dodgerblue', lw=1, ls='--', alpha=.4)
@@ -77,20 +77,20 @@ if not args.no_plot:
             ax.plot(xr, z[1], color='salmon', lw=2)
             ax.plot(xr, z[2], color='dodgerblue', lw=2)
 
-        elif type(trial) in [RSG, CSG]:
+        elif trial.kind in ['RSG', 'CSG']:
             ax.plot(xr, y[0], color='coral', alpha=1, lw=1, label='target')
             ax.plot(xr, z[0], color='cornflowerblue', alpha=1, lw=1.5, label='response')
         elif 'bce' in config.loss:
             ax.scatter(xr, y, color='coral', alpha=0.5, s=3, label='target')
             ax.plot(xr, z, color='cornflowerblue', alpha=1, lw=1.5, label='response')
 
-        elif type(trial) is FlipFlop:
+        elif trial.kind == 'FlipFlop':
             for j in range(trial.dim):
                 ax.plot(xr, x[j], color=cols[j], ls='--', lw=.5, alpha=.4)
                 ax.plot(xr, y[j], color=cols[j], lw=1.5, ls=':')
                 ax.plot(xr, z[j], color=cols[j], lw=2)
 
-        elif type(trial) is DurationDisc:
+        elif trial.kind == 'DurationDisc':
             ax.plot(xr, x[0], color='grey', lw=.5, ls='--', alpha=.4)
             ax.plot(xr, x[1], color='grey', lw=.5, ls='--', alpha=.4)
             ax.plot(xr, x[2], color='salmon', lw=.5, ls='--', alpha=.7)
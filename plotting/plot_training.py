@@ -5,16 +5,21 @@ import random
 import pickle
 import pdb
 import argparse
+import sys
+
+sys.path.append('../')
+
+from utils import load_samples
 
 # for plotting some instances over the course of training
 
 parser = argparse.ArgumentParser()
-parser.add_argument('file', help='some checkpoints file')
+parser.add_argument('file', help='samples folder, or an old checkpoints pickle')
 parser.add_argument('--t_type', default='rsg')
 args = parser.parse_args()
 
-with open(args.file, 'rb') as f:
-    data = pickle.load(f)
+# only the checkpoints being plotted are read
+data = load_samples(args.file)
 
 data_idx = [0]
 data_idx += sorted(random.sample(range(1, len(data) - 1), 10))
@@ -12,6 +12,7 @@ import sys
 import pickle
 import logging
 import random
+import time
 import csv
 import math
 import json
@@ -20,14 +21,14 @@ import pandas as pd
 import string
 
 
-from utils import log_this, load_rb, get_config, update_args, load_args
-from helpers import get_optimizer, get_scheduler, get_criteria, create_loaders
+from utils import log_this, load_rb, get_config, update_args, load_args, append_csv
+from helpers import get_optimizer, get_scheduler, get_criteria, create_loaders, load_stream_config
 
 from tasks import *
 
 from trainer import Trainer
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='')
     # parser.add_argument('-L', type=int, default=5, help='latent input dimension')
     parser.add_argument('--D1', type=int, default=50, help='u dimension')
@@ -51,6 +52,7 @@ def parse_args():
     parser.add_argument('--res_noise', type=float, default=0)
     parser.add_argument('--fixed_pts', type=int, default=0, help='number of fixed pts to include as hopfield')
     parser.add_argument('--fixed_beta', type=float, default=1.5, help='beta to make patterns stronger')
+    parser.add_argument('--res_cache', type=str, default=None, help='folder to keep generated reservoirs in, shared between runs')
     parser.add_argument('--x_noise', type=float, default=0)
     parser.add_argument('--m_noise', type=float, default=0)
     parser.add_argument('--res_bias', action='store_true', help='bias term as part of recurrent connections, with J')
@@ -65,20 +67,38 @@ def parse_args():
     # parser.add_argument('-a', '--add_tasks', type=str, nargs='+', help='add tasks to previously trained reservoir')
     parser.add_argument('-s', '--sequential', action='store_true', help='sequential training')
     parser.add_argument('--owm', action='store_true', help='use orthogonal weight modification')
-    # parser.add_argument('-o', '--train_order', type=int, nargs='+', default=[], help='ids of tasks to train on, in order if sequential flag is enabled. empty for all')
-    # parser.add_argument('--seq_threshold', type=float, default=5, help='threshold for having solved a task before moving on to next one')
+    parser.add_argument('--swt', action='store_true', help='with --sequential, freeze sensory and output weights after the first task')
+    parser.add_argument('-o', '--train_order', type=int, nargs='+', default=[], help='ids of tasks to train on, in order if sequential flag is enabled. empty for all')
+    parser.add_argument('--replay_size', type=int, default=0, help='with --sequential, how many earlier trials to keep for rehearsal. 0 for none')
+    parser.add_argument('--replay_ratio', type=float, default=0.25, help='with --replay_size, fraction of every batch that is replayed')
+    parser.add_argument('--seq_threshold', type=float, default=5, help='threshold for having solved a task before moving on to next one')
     parser.add_argument('--same_test', action='store_true', help='use entire dataset for both training and testing')
+    parser.add_argument('--eval_size', type=int, default=200, help='trials per evaluation batch')
+    parser.add_argument('--test_size', type=int, default=50, help='test trials in the fixed evaluation set, picked with a fixed seed. -1 for all of them')
+    parser.add_argument('--stream', action='store_true', help='datasets are config files, and trials are generated on the fly')
+    parser.add_argument('--n_workers', type=int, default=0, help='dataloader worker processes')
+    parser.add_argument('--persistent_workers', action='store_true', help='keep dataloader workers alive between epochs')
+    parser.add_argument('--prefetch', type=int, default=0, help='batches to prepare ahead, per worker or, without workers, in a background thread. 0 for the default: 2 per worker, no thread')
+    parser.add_argument('--pin_memory', action='store_true', help='pin batches in memory for faster copies to the gpu')
     
     # training arguments
-    parser.add_argument('--optimizer', choices=['adam', 'sgd', 'rmsprop', 'lbfgs'], default='adam')
+    parser.add_argument('--optimizer', choices=['adam', 'sgd', 'rmsprop', 'lbfgs', 'lbfgs-pytorch'], default='adam')
     parser.add_argument('--k', type=int, default=0, help='k for t-bptt. use 0 for full bptt')
+    parser.add_argument('--varpro', action='store_true', help='solve M_ro by ridge regression and only train the rest. needs out_act none and mse. adam only')
+    parser.add_argument('--varpro_interval', type=int, default=1, help='with --varpro, solve M_ro every this many iterations')
+    parser.add_argument('--varpro_decay', type=float, default=0.9, help='with --varpro, how much earlier batches count in the regression. 0 for just the current batch')
+    parser.add_argument('--ridge', type=float, default=1e-2, help='with --varpro, ridge penalty on M_ro')
 
     # adam parameters
     parser.add_argument('--batch_size', type=int, default=1, help='size of minibatch used')
     parser.add_argument('--lr', type=float, default=1e-4, help='learning rate. adam only')
     parser.add_argument('--n_epochs', type=int, default=40, help='number of epochs to train for. adam only')
+    parser.add_argument('--n_iters', type=int, default=None, help='stop after this many iterations. needed with --stream. adam only')
     parser.add_argument('--conv_type', type=str, choices=['patience', 'grad'], default='patience', help='how to determine convergence. adam only')
     parser.add_argument('--patience', type=int, default=4000, help='stop training if loss doesn\'t decrease. adam only')
+    parser.add_argument('--state_path', type=str, default=None, help='carry on training from the state saved here, if there is one, and save it here at the end. adam only')
+    parser.add_argument('--state_interval', type=int, default=0, help='also save the training state every this many iterations; a multiple of log_interval. adam only')
+    parser.add_argument('--resume', type=str, default=None, help='carry on a logged run that was stopped, from the state in its log folder. adam only')
     parser.add_argument('--l2_reg', type=float, default=0, help='amount of l2 regularization')
     parser.add_argument('--s_rate', default=None, type=float, help='scheduler rate. dont use for no scheduler')
     parser.add_argument('--loss', type=str, nargs='+', default=['mse'])
@@ -89,6 +109,9 @@ def parse_args():
 
     # lbfgs parameters
     parser.add_argument('--maxiter', type=int, default=50, help='lbfgs max iterations')
+    parser.add_argument('--lbfgs_batch', type=int, default=None, help='lbfgs-pytorch: trials per step, taken in turn. default is all of them')
+    parser.add_argument('--target_loss', type=float, default=None, help='log how long lbfgs takes to get the training loss below this')
+    parser.add_argument('--lbfgs_procs', type=int, default=0, help='split each lbfgs loss and gradient across this many processes. 0 to do it here')
 
     # seeds
     parser.add_argument('--seed', type=int, help='general purpose seed')
@@ -104,18 +127,29 @@ def parse_args():
     parser.add_argument('--log_interval', type=int, default=50)
     parser.add_argument('--log_checkpoint_models', action='store_true')
     parser.add_argument('--log_checkpoint_samples', action='store_true')
+    parser.add_argument('--full_models', action='store_true', help='save the reservoir weights in every model file, instead of rebuilding them from the seed')
+    parser.add_argument('--async_eval', action='store_true', help='test in a separate process while training continues. adam only')
+    parser.add_argument('--eval_lag', type=int, default=2, help='with --async_eval, how many tests training can get ahead by')
 
     parser.add_argument('--name', type=str, default='test')
     parser.add_argument('--slurm_param_path', type=str, default=None)
     parser.add_argument('--slurm_id', type=int, default=None)
     parser.add_argument('--use_cuda', action='store_true')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 def adjust_args(args):
     # don't use logging.info before we initialize the logger!! or else stuff is gonna fail
 
+    # carrying on a stopped run, with everything exactly as it was. do this before the rest,
+    # which then goes the same way it did the first time
+    if args.resume is not None:
+        c_path = [f for f in os.listdir(args.resume) if f.startswith('config_')][0]
+        config = load_args(os.path.join(args.resume, c_path), to_bunch=False)
+        config['resume'] = args.resume
+        args = update_args(args, config)
+
     # dealing with slurm. do this first!! before anything else
     # needs to be before seed setting, so we can set it
     if args.slurm_id is not None:
@@ -152,6 +186,14 @@ def adjust_args(args):
                 print(f'Warning: based on config, changed {v} from {args.__dict__[v]} -> {config[v]}')
                 args.__dict__[v] = config[v]
 
+    if args.state_interval > 0:
+        assert args.state_interval % args.log_interval == 0, 'state_interval has to be a multiple of log_interval'
+
+    # a stream never runs out, so it needs some other way to stop
+    if args.stream:
+        assert args.optimizer not in ['lbfgs', 'lbfgs-pytorch'], 'lbfgs needs a fixed dataset'
+        assert args.n_iters is not None, 'set an iteration budget with --n_iters'
+
     # shortcut for specifying train everything including reservoir
     if args.train_parts == ['all']:
         args.train_parts = ['']
@@ -170,7 +212,10 @@ def adjust_args(args):
     args.T = len(args.dataset)
     L, Z = 0, 0
     for dset in args.dataset:
-        config = get_config(dset, ctype='dset', to_bunch=True)
+        if args.stream:
+            config = load_stream_config(dset)
+        else:
+            config = get_config(dset, ctype='dset', to_bunch=True)
         L = max(L, config.L)
         Z = max(Z, config.Z)
     args.L = L
@@ -179,10 +224,14 @@ def adjust_args(args):
     # initializing logging
     # do this last, because we will be logging previous parameters into the config file
     if not args.no_log:
+        run_id = args.run_id if args.resume is not None else None
         if args.slurm_id is not None:
-            log = log_this(args, 'logs', os.path.join(args.name.split('_')[0], args.name.split('_')[1]), checkpoints=args.log_checkpoint_models)
+            log = log_this(args, 'logs', os.path.join(args.name.split('_')[0], args.name.split('_')[1]), checkpoints=args.log_checkpoint_models, run_id=run_id)
         else:
-            log = log_this(args, 'logs', args.name, checkpoints=args.log_checkpoint_models)
+            log = log_this(args, 'logs', args.name, checkpoints=args.log_checkpoint_models, run_id=run_id)
+        # the training state goes with the logs, where --resume looks for it
+        if args.state_path is None and (args.state_interval > 0 or args.resume is not None):
+            args.state_path = os.path.join(log.run_dir, 'state.pth')
 
         logging.basicConfig(format='%(message)s', filename=log.run_log, level=logging.DEBUG)
         console = logging.StreamHandler()
@@ -192,6 +241,7 @@ def adjust_args(args):
     else:
         logging.basicConfig(format='%(message)s', level=logging.DEBUG)
         logging.info('NOT LOGGING THIS RUN.')
+        assert args.resume is None, 'only logged runs can be resumed'
 
     # logging, when loading models from paths
     if args.model_path is not None:
@@ -204,37 +254,43 @@ def adjust_args(args):
     return args
 
 
-if __name__ == '__main__':
-    args = parse_args()
+# argv as on the command line. returns the best loss, number of iterations, and time spent setting up
+def main(argv=None):
+    start = time.time()
+    args = parse_args(argv)
     args = adjust_args(args)
 
     trainer = Trainer(args)
-    logging.info(f'Initialized trainer. Using device {trainer.device}, optimizer {args.optimizer}.')
+    setup_time = time.time() - start
+    logging.info(f'Initialized trainer in {setup_time:.1f}s. Using device {trainer.device}, optimizer {args.optimizer}.')
 
     if args.optimizer == 'lbfgs':
         best_loss, n_iters = trainer.optimize_lbfgs()
+    elif args.optimizer == 'lbfgs-pytorch':
+        best_loss, n_iters = trainer.optimize_lbfgs_torch()
     elif args.optimizer in ['sgd', 'rmsprop', 'adam']:
         best_loss, n_iters = trainer.train()
 
     if args.slurm_id is not None:
         # if running many jobs, then we gonna put the results into a csv
+        # many runs can finish at once, so the csv is locked while we write to it
         csv_path = os.path.join('logs', args.name.split('_')[0] + '.csv')
-        csv_exists = os.path.exists(csv_path)
-        with open(csv_path, 'a') as f:
-            writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            labels_csv = ['slurm_id', 'N', 'D1', 'D2', 'seed', 'rseed', 'fp', 'fb', 'mnoise', 'rnoise', 'dset', 'niter', 'tparts', 'loss']
-            vals_csv = [
-                args.slurm_id, args.N, args.D1, args.D2, args.seed,
-                args.res_seed, args.fixed_pts, args.fixed_beta, args.m_noise, args.res_noise,
-                args.dataset, n_iters, '-'.join(args.train_parts), best_loss
-            ]
-            if args.optimizer != 'lbfgs':
-                labels_csv.extend(['lr', 'epochs'])
-                vals_csv.extend([args.lr, args.n_epochs])
-
-            if not csv_exists:
-                writer.writerow(labels_csv)
-            writer.writerow(vals_csv)
+        labels_csv = ['slurm_id', 'N', 'D1', 'D2', 'seed', 'rseed', 'fp', 'fb', 'mnoise', 'rnoise', 'dset', 'niter', 'tparts', 'loss']
+        vals_csv = [
+            args.slurm_id, args.N, args.D1, args.D2, args.seed,
+            args.res_seed, args.fixed_pts, args.fixed_beta, args.m_noise, args.res_noise,
+            args.dataset, n_iters, '-'.join(args.train_parts), best_loss
+        ]
+        if args.optimizer not in ['lbfgs', 'lbfgs-pytorch']:
+            labels_csv.extend(['lr', 'epochs'])
+            vals_csv.extend([args.lr, args.n_epochs])
+        append_csv(csv_path, labels_csv, [vals_csv])
 
     logging.shutdown()
+    return best_loss, n_iters, setup_time
+
+
+if __name__ == '__main__':
+    main()
+
 
@@ -0,0 +1,131 @@
+import numpy as np
+import torch
+
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import pdb
+
+from torch.utils.data import BatchSampler
+
+from network import tensor_hash
+from helpers import create_loaders
+
+# recordings of a trained network's states over a set of trials, so analysis scripts can share one
+# run of the network instead of each simulating it again. a recording is a folder with a chunk of
+# arrays per batch of trials, written as they're made and memory-mapped when they're read:
+#   x_0000.npy  [B, T, N]   reservoir states
+#   u_0000.npy  [B, T, D1]  output of M_u, going into the reservoir
+#   v_0000.npy  [B, T, D2]  output of the reservoir, going into M_ro
+#   trials_0000.pkl         the trials themselves
+# T is the longest trial in the chunk, so it can be different for each chunk. folders are named by a
+# hash of the model weights and the trials, and only show up once they're complete
+PARTS = ['x', 'u', 'v']
+
+# batches from a loader, until there are n trials. random batching uses its own seeded generator, and
+# test streams start from the same trials, so going through it again gives the same trials
+def state_batches(loader, n):
+    if isinstance(loader.sampler, BatchSampler) and hasattr(loader.sampler.sampler, 'generator'):
+        loader.sampler.sampler.generator = torch.Generator().manual_seed(0)
+    # the loader draws a seed for its workers too
+    loader.generator = torch.Generator().manual_seed(0)
+    count = 0
+    for x, y, trials in loader:
+        if count + len(x) > n:
+            x, y, trials = x[:n - count], y[:n - count], trials[:n - count]
+        yield x, y, trials
+        count += len(x)
+        if count >= n:
+            return
+
+# what the network goes through on a batch x, as {part: [B, T, dim]}, starting from res_state
+def run_states(net, x, res_state=None):
+    states = {}
+    with torch.no_grad():
+        net.reset(res_state)
+        for j in range(x.shape[2]):
+            _, extras = net(x[:,:,j], extras=True)
+            # there's no x without a reservoir
+            for k in PARTS:
+                if k in extras:
+                    states.setdefault(k, []).append(extras[k])
+    return {k: torch.stack(v, dim=1) for k, v in states.items()}
+
+# what identifies a recording: the weights, which trials, and how they're stored
+def recording_key(net, datasets, n_trials, batch_size, dtype, context_filter=[], res_state=None):
+    spec = {
+        'model': tensor_hash(net.state_dict()),
+        'res_state': res_state,
+        'datasets': [os.path.abspath(d) for d in datasets],
+        'mtimes': [os.path.getmtime(d) for d in datasets],
+        'n_trials': n_trials,
+        'batch_size': batch_size,
+        'dtype': dtype,
+        'context_filter': sorted(context_filter)
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16], spec
+
+# runs the network over the trials from a loader and writes what it goes through, a batch at a time
+def record_states(net, loader, n_trials, path, dtype='float32', spec=None, res_state=None):
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    chunks = []
+    for ix, (x, y, trials) in enumerate(state_batches(loader, n_trials)):
+        for k, A in run_states(net, x, res_state).items():
+            arr = np.lib.format.open_memmap(os.path.join(tmp, f'{k}_{ix:04d}.npy'), mode='w+', dtype=dtype, shape=tuple(A.shape))
+            arr[:] = A.numpy()
+            arr.flush()
+            del arr
+        with open(os.path.join(tmp, f'trials_{ix:04d}.pkl'), 'wb') as f:
+            pickle.dump(list(trials), f)
+        chunks.append(len(x))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'chunks': chunks, 'dtype': dtype, 'spec': spec}, f, indent=2)
+    os.replace(tmp, path)
+    return StateRecording(path)
+
+# the recording of net on the trials, making it first if there isn't one yet.
+# recordings go in a states folder next to the model unless root says otherwise
+def get_recording(net, config, datasets, n_trials, batch_size=100, dtype='float32', root=None, context_filter=[]):
+    if root is None:
+        root = os.path.join(os.path.dirname(config.model_path), 'states')
+    # the same starting state as training and testing
+    res_state = config.res_x_init if hasattr(config, 'res_x_init') else None
+    key, spec = recording_key(net, datasets, n_trials, batch_size, dtype, context_filter, res_state)
+    path = os.path.join(root, key)
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        return StateRecording(path)
+    _, loader = create_loaders(datasets, config, split_test=False, test_size=batch_size, context_filter=context_filter)
+    return record_states(net, loader, n_trials, path, dtype, spec, res_state)
+
+class StateRecording:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.chunk_sizes = meta['chunks']
+        self.dtype = meta['dtype']
+        self.spec = meta['spec']
+
+    def __len__(self):
+        return sum(self.chunk_sizes)
+
+    # memory-mapped [B, T, dim] states of a chunk, read only
+    def chunk(self, ix, part='x'):
+        return np.load(os.path.join(self.path, f'{part}_{ix:04d}.npy'), mmap_mode='r')
+
+    def chunk_trials(self, ix):
+        with open(os.path.join(self.path, f'trials_{ix:04d}.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    # (states, trials) for each chunk, with states as float32 tensors like get_states gives
+    def chunks(self, part='x'):
+        for ix in range(len(self.chunk_sizes)):
+            yield torch.from_numpy(np.array(self.chunk(ix, part), dtype=np.float32)), self.chunk_trials(ix)
+
+    def trials(self):
+        return [t for ix in range(len(self.chunk_sizes)) for t in self.chunk_trials(ix)]
@@ -0,0 +1,345 @@
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import traceback
+import logging
+import multiprocessing as mp
+import pdb
+
+from utils import read_csv_ids
+
+# runs a parameters.py grid locally, instead of as a slurm array (run), or a slice of it in one process (warm).
+# with run, every run gets its own process pinned to its own cores, and its results go to the same csv that
+# slurm runs use (logs/<name>.csv). runs that are already in there are skipped, so a sweep can be restarted
+
+# free groups of cores, shared by all the pool's processes
+core_groups = None
+
+def init_worker(groups):
+    global core_groups
+    core_groups = groups
+
+def set_threads(n_threads):
+    # before torch is imported, so the thread pools start out the right size
+    os.environ['OMP_NUM_THREADS'] = str(n_threads)
+    os.environ['MKL_NUM_THREADS'] = str(n_threads)
+    import torch
+    torch.set_num_threads(n_threads)
+
+# imports run.py (and with it torch, scipy, pandas...), returning it and how long that took
+def import_run():
+    start = time.time()
+    import run
+    return run, time.time() - start
+
+def run_job(job):
+    slurm_id, argv, n_threads, quiet = job
+    cores = core_groups.get()
+    start = time.time()
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        set_threads(n_threads)
+        if quiet:
+            # every run has its own log file already
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+        run, import_time = import_run()
+        best_loss, n_iters, setup_time = run.main(argv)
+        return slurm_id, best_loss, n_iters, time.time() - start, import_time + setup_time, None
+    except Exception:
+        return slurm_id, None, None, time.time() - start, None, traceback.format_exc()
+    finally:
+        core_groups.put(cores)
+
+# splits the cores we're allowed to use into n groups of n_threads
+def split_cores(n, n_threads):
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    groups = []
+    for i in range(n):
+        groups.append([cpus[(i * n_threads + j) % len(cpus)] for j in range(n_threads)])
+    return groups
+
+# slurm_ids in the grid that don't have results yet
+def pending_ids(param_path, name, ids=None):
+    with open(param_path, 'r') as f:
+        mapping = json.load(f)
+    all_ids = sorted(int(i) for i in mapping.keys())
+    if ids is not None:
+        all_ids = [i for i in all_ids if i in ids]
+    done = read_csv_ids(os.path.join('logs', name + '.csv'))
+    return [i for i in all_ids if i not in done], len(done)
+
+def run_sweep(args, extra):
+    assert '_' not in args.name, 'run names are <name>_<slurm_id>, so the sweep name can\'t have underscores'
+    os.makedirs('logs', exist_ok=True)
+    ids, n_done = pending_ids(args.param_path, args.name, args.ids)
+    print(f'{len(ids)} runs to do, {n_done} already done', flush=True)
+    if len(ids) == 0:
+        return
+
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    n_threads = args.threads if args.threads is not None else max(1, n_cpus // args.n_procs)
+    groups = mp.Queue()
+    for g in split_cores(args.n_procs, n_threads):
+        groups.put(g)
+    print(f'Using {args.n_procs} processes with {n_threads} threads each', flush=True)
+
+    jobs = []
+    for i in ids:
+        argv = ['--slurm_id', str(i), '--slurm_param_path', args.param_path, '--name', f'{args.name}_{i}'] + extra
+        jobs.append((i, argv, n_threads, not args.verbose))
+
+    start = time.time()
+    n_failed = 0
+    startup_times = []
+    # a fresh process for every run, so nothing carries over between them
+    with mp.Pool(args.n_procs, initializer=init_worker, initargs=(groups,), maxtasksperchild=1) as pool:
+        for k, (i, best_loss, n_iters, t, startup, err) in enumerate(pool.imap_unordered(run_job, jobs)):
+            if err is not None:
+                n_failed += 1
+                print(f'[{k+1}/{len(jobs)}] slurm_id {i} failed after {t:.0f}s:\n{err}', flush=True)
+            else:
+                startup_times.append(startup)
+                print(f'[{k+1}/{len(jobs)}] slurm_id {i}: loss {best_loss:.3f}, {n_iters} iterations, {t:.0f}s ({startup:.1f}s startup)', flush=True)
+    print(f'Finished {len(jobs) - n_failed} runs in {time.time() - start:.0f}s. {n_failed} failed, and will be run again next time', flush=True)
+    if len(startup_times) > 0:
+        print(f'Startup: {sum(startup_times) / len(startup_times):.1f}s per run', flush=True)
+
+# root logger handlers from the previous run, so the next one's logging.basicConfig takes effect
+def reset_logging():
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+        h.close()
+
+# runs slurm_ids one after the other in this process. torch and everything else is only imported once,
+# and datasets, rendered test sets and reservoirs are kept around for the runs after that use them too
+def run_warm(args, extra):
+    assert '_' not in args.name, 'run names are <name>_<slurm_id>, so the sweep name can\'t have underscores'
+    os.makedirs('logs', exist_ok=True)
+    lo, hi = args.range
+    ids, _ = pending_ids(args.param_path, args.name, set(range(lo, hi + 1)))
+    print(f'{len(ids)} runs to do in slurm_ids {lo}-{hi}', flush=True)
+    if len(ids) == 0:
+        return
+
+    if args.threads is not None:
+        set_threads(args.threads)
+    run, import_time = import_run()
+    import helpers
+    import network
+    helpers.TABLE_CACHE = {}
+    helpers.RENDER_CACHE = {}
+    network.RESERVOIRS = {}
+
+    start = time.time()
+    out = sys.stdout
+    setup_times = []
+    for k, i in enumerate(ids):
+        argv = ['--slurm_id', str(i), '--slurm_param_path', args.param_path, '--name', f'{args.name}_{i}'] + extra
+        reset_logging()
+        t = time.time()
+        if not args.verbose:
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+        try:
+            best_loss, n_iters, setup_time = run.main(argv)
+            err = None
+        except Exception:
+            err = traceback.format_exc()
+        finally:
+            if not args.verbose:
+                sys.stdout.close()
+            sys.stdout, sys.stderr = out, sys.__stderr__
+        if err is not None:
+            print(f'[{k+1}/{len(ids)}] slurm_id {i} failed after {time.time() - t:.0f}s:\n{err}', flush=True)
+            continue
+        setup_times.append(setup_time)
+        print(f'[{k+1}/{len(ids)}] slurm_id {i}: loss {best_loss:.3f}, {n_iters} iterations, {time.time() - t:.0f}s ({setup_time:.1f}s setup)', flush=True)
+
+    n_done = len(setup_times)
+    print(f'Finished {n_done} runs in {time.time() - start:.0f}s. {len(ids) - n_done} failed, and will be run again next time', flush=True)
+    if n_done > 0:
+        amortized = (import_time + sum(setup_times)) / n_done
+        print(f'Startup: {import_time:.1f}s of imports once, then {setup_times[0]:.1f}s setting up the first run and {sum(setup_times[1:]) / max(n_done - 1, 1):.1f}s the rest. {amortized:.1f}s per run amortized', flush=True)
+
+
+# asynchronous successive halving (ASHA). every run starts with a budget of min_iters iterations, and runs
+# that are in the best 1/eta of those that reached the same budget get promoted to eta times more, up to
+# max_iters. runs carry on from where they stopped through --state_path. the scheduler's own state is
+# saved after every result, so a sweep can be restarted
+class ASHA:
+    def __init__(self, ids, min_iters, max_iters, eta=3, path=None):
+        self.min_iters = min_iters
+        self.eta = eta
+        self.budgets = [min_iters]
+        while self.budgets[-1] * eta <= max_iters:
+            self.budgets.append(self.budgets[-1] * eta)
+        self.path = path
+        # per slurm_id: losses at each rung reached, rungs promoted from, whether it stopped on its own, and
+        # its seeds. run.py draws new seeds every time it starts, and carrying on needs the same reservoir
+        self.runs = {i: {'losses': {}, 'promoted': [], 'converged': False, 'seeds': self.draw_seeds()} for i in ids}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            for i, r in saved['runs'].items():
+                r['losses'] = {int(k): v for k, v in r['losses'].items()}
+                self.runs[int(i)] = r
+        self.running = set()
+
+    # the same way run.py picks them. seeds in the grid still win, since run.py applies it after the args
+    def draw_seeds(self):
+        return {k: random.randint(0, 999999) for k in ['seed', 'network_seed', 'res_seed']}
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'budgets': self.budgets, 'eta': self.eta, 'runs': self.runs}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    # highest rung a run has a result for, or -1
+    def rung(self, i):
+        return max(self.runs[i]['losses'].keys(), default=-1)
+
+    # next (slurm_id, rung) to run, or None if everything left has to wait for results
+    def next_job(self):
+        # runs that were promoted but never finished, e.g. because the sweep was stopped
+        for i, r in self.runs.items():
+            if i not in self.running and len(r['promoted']) > 0 and max(r['promoted']) == self.rung(i):
+                return i, self.rung(i) + 1
+        # promotions, from the highest rung down
+        for k in reversed(range(len(self.budgets) - 1)):
+            at_k = sorted((r['losses'][k], i) for i, r in self.runs.items() if k in r['losses'])
+            for loss, i in at_k[:len(at_k) // self.eta]:
+                r = self.runs[i]
+                if k not in r['promoted'] and not r['converged'] and i not in self.running:
+                    r['promoted'].append(k)
+                    return i, k + 1
+        # otherwise start something new
+        for i, r in self.runs.items():
+            if self.rung(i) == -1 and i not in self.running:
+                return i, 0
+        return None
+
+    def start(self, i):
+        self.running.add(i)
+
+    def report(self, i, k, loss, n_iters):
+        self.running.discard(i)
+        self.runs[i]['losses'][k] = loss
+        # stopping early means patience ran out or epochs did, so more iterations won't help
+        if n_iters < self.budgets[k]:
+            self.runs[i]['converged'] = True
+        self.save()
+
+    # failed runs go back to where they were
+    def failed(self, i, k):
+        self.running.discard(i)
+        if k > 0 and k - 1 in self.runs[i]['promoted']:
+            self.runs[i]['promoted'].remove(k - 1)
+
+    # slurm_ids by how far they got, then by loss there
+    def ranking(self):
+        ranked = [(-self.rung(i), r['losses'][self.rung(i)], i) for i, r in self.runs.items() if self.rung(i) >= 0]
+        return [(i, -k, loss) for k, loss, i in sorted(ranked)]
+
+def run_asha(args, extra):
+    assert '_' not in args.name, 'run names are <name>_<slurm_id>, so the sweep name can\'t have underscores'
+    with open(args.param_path, 'r') as f:
+        ids = sorted(int(i) for i in json.load(f).keys())
+    # every rung of a run logs a row and a folder of its own. they go under a name of their own too, so
+    # `sweep run --name <name>` doesn't take a run that's only been through a rung or two as done
+    name = args.name + '-asha'
+    run_dir = os.path.join('logs', name)
+    os.makedirs(run_dir, exist_ok=True)
+    asha = ASHA(ids, args.min_iters, args.max_iters, args.eta, os.path.join(run_dir, 'asha.json'))
+    print(f'{len(ids)} runs, with budgets of {asha.budgets} iterations', flush=True)
+
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    n_threads = args.threads if args.threads is not None else max(1, n_cpus // args.n_procs)
+    groups = mp.Queue()
+    for g in split_cores(args.n_procs, n_threads):
+        groups.put(g)
+
+    start = time.time()
+    with mp.Pool(args.n_procs, initializer=init_worker, initargs=(groups,), maxtasksperchild=1) as pool:
+        pending = {}
+        while True:
+            # keep every process busy, as long as there's something to do
+            while len(pending) < args.n_procs:
+                job = asha.next_job()
+                if job is None:
+                    break
+                i, k = job
+                asha.start(i)
+                argv = [
+                    '--slurm_id', str(i), '--slurm_param_path', args.param_path, '--name', f'{name}_{i}',
+                    '--n_iters', str(asha.budgets[k]), '--state_path', os.path.join(run_dir, f'state_{i}.pth')
+                ] + [a for k_s, v in asha.runs[i]['seeds'].items() for a in ['--' + k_s, str(v)]] + extra
+                pending[i] = (k, pool.apply_async(run_job, ((i, argv, n_threads, not args.verbose),)))
+            if len(pending) == 0:
+                break
+            done = [i for i, (k, res) in pending.items() if res.ready()]
+            if len(done) == 0:
+                time.sleep(.5)
+                continue
+            for i in done:
+                k, res = pending.pop(i)
+                _, best_loss, n_iters, t, startup, err = res.get()
+                if err is not None:
+                    asha.failed(i, k)
+                    print(f'slurm_id {i} failed at {asha.budgets[k]} iterations:\n{err}', flush=True)
+                    continue
+                asha.report(i, k, best_loss, n_iters)
+                print(f'slurm_id {i}: loss {best_loss:.3f} at {n_iters} iterations (rung {k}), {t:.0f}s', flush=True)
+
+    print(f'Finished in {time.time() - start:.0f}s. Best runs:', flush=True)
+    for i, k, loss in asha.ranking()[:10]:
+        print(f'  slurm_id {i}: loss {loss:.3f} at {asha.budgets[k]} iterations', flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run parameters.py grids locally')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('run', help='run every slurm_id in the grid that isn\'t done yet. other args are passed on to run.py')
+    p.add_argument('param_path', help='grid made by parameters.py, e.g. slurm_params/params.json')
+    p.add_argument('-n', '--n_procs', type=int, default=2, help='runs at a time')
+    p.add_argument('--threads', type=int, default=None, help='torch threads per run. default splits the cores evenly')
+    p.add_argument('--name', type=str, default='sweep', help='results go to logs/<name>.csv, runs to logs/<name>/<slurm_id>')
+    p.add_argument('--ids', type=int, nargs='+', default=None, help='only these slurm_ids')
+    p.add_argument('-v', '--verbose', action='store_true', help='show output from the runs')
+
+    p = sub.add_parser('warm', help='run a range of slurm_ids one after the other in this process, reusing whatever they share')
+    p.add_argument('param_path', help='grid made by parameters.py, e.g. slurm_params/params.json')
+    p.add_argument('--range', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'), help='slurm_ids to run, inclusive')
+    p.add_argument('--threads', type=int, default=None, help='torch threads')
+    p.add_argument('--name', type=str, default='sweep', help='results go to logs/<name>.csv, runs to logs/<name>/<slurm_id>')
+    p.add_argument('-v', '--verbose', action='store_true', help='show output from the runs')
+
+    p = sub.add_parser('asha', help='run the grid with successive halving: only the best runs get to train for longer')
+    p.add_argument('param_path', help='grid made by parameters.py, e.g. slurm_params/params.json')
+    p.add_argument('--min_iters', type=int, default=500, help='iterations every run gets')
+    p.add_argument('--max_iters', type=int, default=13500, help='most iterations any run gets')
+    p.add_argument('--eta', type=int, default=3, help='1/eta of the runs at each budget get promoted to eta times the budget')
+    p.add_argument('-n', '--n_procs', type=int, default=2, help='runs at a time')
+    p.add_argument('--threads', type=int, default=None, help='torch threads per run. default splits the cores evenly')
+    p.add_argument('--name', type=str, default='sweep', help='runs and scheduler state go to logs/<name>-asha, results to logs/<name>-asha.csv')
+    p.add_argument('-v', '--verbose', action='store_true', help='show output from the runs')
+
+    args, extra = parser.parse_known_args()
+    if args.command == 'run':
+        run_sweep(args, extra)
+    elif args.command == 'warm':
+        run_warm(args, extra)
+    elif args.command == 'asha':
+        run_asha(args, extra)
+    else:
+        parser.print_help()
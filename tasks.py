@@ -15,9 +15,11 @@ import matplotlib as mpl
 from matplotlib import collections as matcoll
 
 import argparse
+import multiprocessing as mp
 
 # from motifs import gen_fn_motifs
 from utils import update_args, load_args, load_rb, Bunch
+from columnar import TrialTable, concat_columns, save_table, load_dataset
 
 eps = 1e-6
 
@@ -43,6 +45,12 @@ class Task:
     def get_y(self):
         pass
 
+    # draw the parameters of n trials at once from np.random.Generator rng
+    # returns (shared, columns) in the layout of columnar.TrialTable
+    @staticmethod
+    def sample(args, n, rng):
+        raise NotImplementedError
+
 class RSG(Task):
     def __init__(self, args, dset_id=None, n=None):
         super().__init__(args.t_len, dset_id, n)
@@ -64,6 +72,25 @@ class RSG(Task):
         self.L = 1
         self.Z = 1
 
+    @staticmethod
+    def sample(args, n, rng):
+        if args.intervals is None:
+            t_o = rng.integers(args.min_t, args.max_t, n)
+        else:
+            t_o = rng.choice(args.intervals, n)
+        t_p = (t_o * args.gain).astype(int)
+        ready_time = rng.integers(args.p_len * 2, args.max_ready, n)
+        set_time = ready_time + t_o
+        go_time = set_time + t_p
+
+        shared = {'L': 1, 'Z': 1, 'p_len': args.p_len}
+        columns = {
+            'rsg': np.stack((ready_time, set_time, go_time), axis=1),
+            't_o': t_o,
+            't_p': t_p
+        }
+        return shared, columns
+
     def get_x(self, args=None):
         rt, st, gt = self.rsg
         # ready pulse
@@ -118,6 +145,28 @@ class CSG(Task):
         self.L = 1
         self.Z = 1
 
+    @staticmethod
+    def sample(args, n, rng):
+        if args.intervals is None:
+            t_p = rng.integers(args.min_t, args.max_t, n)
+            t_percentile = (t_p - args.min_t) / (args.max_t - args.min_t)
+        else:
+            ix = rng.integers(len(args.intervals), size=n)
+            t_p = np.asarray(args.intervals)[ix]
+            t_percentile = ix / len(args.intervals)
+        cue_time = rng.integers(args.p_len * 2, args.max_cue, n)
+        set_time = cue_time + rng.integers(args.p_len * 2, args.max_cue, n)
+        go_time = set_time + t_p
+        assert np.all(go_time < args.t_len)
+
+        shared = {'L': 1, 'Z': 1, 'p_len': args.p_len}
+        columns = {
+            'csg': np.stack((cue_time, set_time, go_time), axis=1),
+            't_p': t_p,
+            't_percentile': t_percentile
+        }
+        return shared, columns
+
     def get_x(self, args=None):
         x = np.zeros((1, self.t_len))
         ct, st, gt = self.csg
@@ -151,6 +200,13 @@ class DelayProAnti(Task):
         self.L = 3
         self.Z = 3
 
+    @staticmethod
+    def sample(args, n, rng):
+        theta = sample_angles(args, n, rng)
+        shared = {'L': 3, 'Z': 3, 'fix': args.fix_t, 'stim': args.fix_t + args.stim_t}
+        columns = {'stimulus': np.stack((np.cos(theta), np.sin(theta)), axis=1)}
+        return shared, columns
+
     def get_x(self, args=None):
         x = np.zeros((3, self.t_len))
         # 0 is fixation, the remainder are stimulus
@@ -187,6 +243,19 @@ class MemoryProAnti(Task):
         self.L = 3
         self.Z = 3
 
+    @staticmethod
+    def sample(args, n, rng):
+        theta = sample_angles(args, n, rng)
+        shared = {
+            'L': 3,
+            'Z': 3,
+            'fix': args.fix_t,
+            'stim': args.fix_t + args.stim_t,
+            'memory': args.fix_t + args.stim_t + args.memory_t
+        }
+        columns = {'stimulus': np.stack((np.cos(theta), np.sin(theta)), axis=1)}
+        return shared, columns
+
     def get_x(self, args=None):
         x = np.zeros((3, self.t_len))
         x[0,:self.memory] = 1
@@ -211,14 +280,11 @@ class DelayCopy(Task):
         self.s_len = self.t_len // 2
         x_r = np.arange(self.s_len)
 
-        x = np.zeros((args.dim, self.s_len))
-            
         freqs = np.random.uniform(args.f_range[0], args.f_range[1], (args.dim, args.n_freqs))
         amps = np.random.uniform(-args.amp, args.amp, (args.dim, args.n_freqs))
 
-        for i in range(args.dim):
-            for j in range(args.n_freqs):
-                x[i] = x[i] + amps[i,j] * np.sin(1/freqs[i,j] * x_r) / np.sqrt(args.n_freqs)
+        # sum of sines over the frequency axis, for every dimension at once
+        x = np.sum(amps[:,:,None] * np.sin(1/freqs[:,:,None] * x_r), axis=1) / np.sqrt(args.n_freqs)
 
         self.t_type = args.t_type
         self.dim = args.dim
@@ -227,6 +293,22 @@ class DelayCopy(Task):
         self.L = args.dim
         self.Z = args.dim
 
+    # patterns themselves are too big to store for large datasets, so keep the
+    # sine components instead and let the renderer build the pattern
+    @staticmethod
+    def sample(args, n, rng):
+        freqs = rng.uniform(args.f_range[0], args.f_range[1], (n, args.dim, args.n_freqs))
+        amps = rng.uniform(-args.amp, args.amp, (n, args.dim, args.n_freqs))
+        shared = {
+            'L': args.dim,
+            'Z': args.dim,
+            'dim': args.dim,
+            's_len': args.t_len // 2,
+            'n_freqs': args.n_freqs
+        }
+        columns = {'freqs': freqs, 'amps': amps}
+        return shared, columns
+
     def get_x(self, args=None):
         x = np.zeros((self.dim, self.t_len))
         x[:self.dim, :self.s_len] = self.pattern
@@ -260,6 +342,21 @@ class FlipFlop(Task):
         self.L = args.dim
         self.Z = args.dim
 
+    @staticmethod
+    def sample(args, n, rng):
+        # every gap is at least 1 + p_len long, so this many gaps always reaches t_len
+        max_keys = args.t_len // (args.p_len + 1) + 1
+        gaps = rng.geometric(args.geop, (n, args.dim, max_keys)) + args.p_len
+        cum_xlen = np.cumsum(gaps, axis=2)
+        signs = rng.choice([-1, 1], (n, args.dim, max_keys))
+        # keys past the end of the trial become 0, which is the padding value
+        keys = np.where(cum_xlen < args.t_len, signs * (cum_xlen - args.p_len), 0)
+        n_keys = max(np.max(np.sum(cum_xlen < args.t_len, axis=2)), 1)
+
+        shared = {'L': args.dim, 'Z': args.dim, 'dim': args.dim, 'p_len': args.p_len}
+        columns = {'keys': keys[:, :, :n_keys]}
+        return shared, columns
+
     def get_x(self, args=None):
         x = np.zeros((self.dim, self.t_len))
         for i in range(self.dim):
@@ -301,6 +398,22 @@ class DurationDisc(Task):
         self.L = 4
         self.Z = 2
 
+    @staticmethod
+    def sample(args, n, rng):
+        s1_t = rng.integers(args.tau, args.sep_t - args.max_d - args.tau, n)
+        s_lens = rng.integers(args.min_d, args.max_d, (n, 2))
+        s2_t = rng.integers(args.sep_t + args.tau, args.cue_t - args.max_d - args.tau, n)
+        cue_id = rng.choice([1, -1], n)
+
+        shared = {'L': 4, 'Z': 2, 'cue_t': args.cue_t, 'select_t': args.select_t}
+        columns = {
+            's1': np.stack((s1_t, s_lens[:,0]), axis=1),
+            's2': np.stack((s2_t, s_lens[:,1]), axis=1),
+            'cue_id': cue_id,
+            'direction': (s_lens[:,0] < s_lens[:,1]) ^ (cue_id == 1)
+        }
+        return shared, columns
+
     def get_x(self, args=None):
         x = np.zeros((4, self.t_len))
         s1, s1l = self.s1
@@ -350,6 +463,12 @@ class DM(Task):
 
 
 
+# angles for the pro/anti tasks, in radians
+def sample_angles(args, n, rng):
+    if args.angles is None:
+        return rng.random(n) * 2 * np.pi
+    return rng.choice(args.angles, n) * np.pi / 180
+
 # ways to add noise to x
 def corrupt_x(args, x):
     x += np.random.normal(scale=args.x_noise, size=x.shape)
@@ -362,10 +481,12 @@ def shift_x(x, m_noise, t_p):
     x = np.roll(x, disp)
     return x
 
-def create_dataset(args):
-    t_type = args.t_type
-    n_trials = args.n_trials
+# number of trials drawn from each child seed when sampling in batches
+# fixed, so that a dataset only depends on the seed and not on how many processes made it
+CHUNK_TRIALS = 50000
 
+def get_task_obj(args):
+    t_type = args.t_type
     if t_type.startswith('rsg'):
         assert args.max_ready + args.max_t + int(args.max_t * args.gain) < args.t_len
         TaskObj = RSG
@@ -387,6 +508,62 @@ def create_dataset(args):
         TaskObj = DurationDisc
     else:
         raise NotImplementedError
+    return TaskObj
+
+def sample_chunk(TaskObj, args, n, seed_seq):
+    rng = np.random.default_rng(seed_seq)
+    return TaskObj.sample(args, n, rng)
+
+# draws the whole dataset as arrays with the batch samplers, as a columnar.TrialTable
+# chunks of CHUNK_TRIALS are sampled in n_procs processes
+def create_dataset(args):
+    TaskObj = get_task_obj(args)
+    n_trials = args.n_trials
+    if not hasattr(args, 'seed') or args.seed is None:
+        args.seed = int(np.random.randint(1e6))
+    n_procs = args.n_procs if hasattr(args, 'n_procs') else 1
+
+    n_chunks = max(int(np.ceil(n_trials / CHUNK_TRIALS)), 1)
+    seed_seqs = np.random.SeedSequence(args.seed).spawn(n_chunks)
+    chunks = []
+    for i in range(n_chunks):
+        n = min(CHUNK_TRIALS, n_trials - i * CHUNK_TRIALS)
+        chunks.append((TaskObj, args, n, seed_seqs[i]))
+    if n_procs > 1 and n_chunks > 1:
+        with mp.Pool(min(n_procs, n_chunks)) as pool:
+            samples = pool.starmap(sample_chunk, chunks)
+    else:
+        samples = [sample_chunk(*c) for c in chunks]
+
+    shared = samples[0][0]
+    columns = concat_columns([c for s, c in samples])
+    table = make_table(TaskObj, args, shared, columns)
+    args.L = shared['L']
+    args.Z = shared['Z']
+
+    return table, args
+
+def make_table(TaskObj, args, shared, columns):
+    columns['n'] = np.arange(len(columns[next(iter(columns))]))
+    header = {
+        'kind': TaskObj.__name__,
+        't_type': args.t_type,
+        't_len': args.t_len,
+        'dset_id': args.name,
+    }
+    header.update(shared)
+    return TrialTable(header, columns)
+
+# n fresh trials from a dataset config, for generating trials on the fly
+def sample_trials(args, n, rng):
+    TaskObj = get_task_obj(args)
+    shared, columns = TaskObj.sample(args, n, rng)
+    return make_table(TaskObj, args, shared, columns)
+
+# old way of creating datasets, one Task object per trial
+def create_dataset_objects(args):
+    TaskObj = get_task_obj(args)
+    n_trials = args.n_trials
 
     trials = []
     for n in range(n_trials):
@@ -476,9 +653,12 @@ def get_tval(targs, name, default, dtype, n_vals=1):
 
 
 def save_dataset(dset, name, config=None):
-    fname = os.path.join('datasets', name + '.pkl')
-    with open(fname, 'wb') as f:
-        pickle.dump(dset, f)
+    if isinstance(dset, TrialTable):
+        save_table(dset, os.path.join('datasets', name + '.npz'))
+    else:
+        fname = os.path.join('datasets', name + '.pkl')
+        with open(fname, 'wb') as f:
+            pickle.dump(dset, f)
     gname = os.path.join('datasets', 'configs', name + '.json')
     if config is not None:
         with open(gname, 'w') as f:
@@ -494,6 +674,9 @@ if __name__ == '__main__':
     # general dataset arguments
     parser.add_argument('-t', '--t_type', default='rsg', help='type of trial to create')
     parser.add_argument('-n', '--n_trials', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=None, help='seed for sampling trials')
+    parser.add_argument('--n_procs', type=int, default=1, help='processes to sample large datasets with')
+    parser.add_argument('--pkl', action='store_true', help='save as a pickle of Task objects rather than .npz')
 
     # task-specific arguments
     parser.add_argument('-a', '--task_args', nargs='*', default=[], help='terms to specify parameters of trial type')
@@ -519,15 +702,22 @@ if __name__ == '__main__':
 
     if args.mode == 'create':
         # create and save a dataset
-        dset, config = create_dataset(args)
+        if args.pkl:
+            dset, config = create_dataset_objects(args)
+        else:
+            dset, config = create_dataset(args)
         save_dataset(dset, args.name, config=config)
     elif args.mode == 'load':
         # visualize a dataset
-        dset = load_rb(args.name)
-        t_type = type(dset[0])
+        dset = load_dataset(args.name)
+        if isinstance(dset, TrialTable):
+            # rows of a columnar dataset stand in for the Task class named by their kind
+            t_type = globals()[dset.kind]
+        else:
+            t_type = type(dset[0])
         xr = np.arange(dset[0].t_len)
 
-        samples = random.sample(dset, 12)
+        samples = [dset[i] for i in random.sample(range(len(dset)), 12)]
         fig, ax = plt.subplots(3,4,sharex=True, sharey=True, figsize=(10,6))
         for i, ax in enumerate(fig.axes):
             ax.axvline(x=0, color='dimgray', alpha = 1)
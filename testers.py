@@ -15,6 +15,7 @@ from network import M2Net, M2Reservoir
 from utils import Bunch, load_rb, get_config
 
 from helpers import get_criteria, create_loaders
+from states import run_states
 
 
 def load_model_path(path, config=None):
@@ -24,6 +25,7 @@ def load_model_path(path, config=None):
         config = Bunch(**config)
     config.model_path = path
 
+    # compact model files only have the trained parameters, so M2Net rebuilds the reservoir from its seed
     # net = BasicNetwork(config)
     net = M2Net(config)
 
@@ -77,17 +79,9 @@ def test_model(net, config, n_tests=128):
 
 # returns hidden states as [N, T, H]
 # note: this returns hidden states as the last dimension, not timesteps!
-def get_states(net, x):
-    states = []
-    with torch.no_grad():
-        net.reset()
-        for j in range(x.shape[2]):
-            net_in = x[:,:,j]
-            net_out, extras = net(net_in, extras=True)
-            states.append(extras['x'])
-
-    A = torch.stack(states, dim=1)
-    return A
+# states.get_recording keeps them on disk for scripts that go over a lot of trials
+def get_states(net, x, res_state=None):
+    return run_states(net, x, res_state)['x']
 
 def test_fixed_pts():
     torch.manual_seed(4)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are all at the top of the repo, and scripts import them from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
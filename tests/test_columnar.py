@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import os
+
+from utils import Bunch, update_args
+from columnar import trials_to_table, render_table, load_pickle, RENDERERS
+import tasks
+
+T_TYPES = ['rsg', 'csg', 'delay-copy', 'flip-flop', 'delay-pro', 'delay-anti', 'memory-pro', 'memory-anti', 'dur-disc']
+
+def task_args(t_type, n_trials=20, seed=0):
+    args = Bunch(t_type=t_type, task_args=[], intervals=None, angles=None, n_trials=n_trials, seed=seed, name=t_type)
+    return update_args(args, tasks.get_task_args(args))
+
+def test_every_kind_has_a_renderer():
+    for t_type in T_TYPES:
+        assert tasks.get_task_obj(task_args(t_type)).__name__ in RENDERERS
+
+# old pickles: Task objects turned into a table render the same as the objects themselves
+@pytest.mark.parametrize('t_type', T_TYPES)
+def test_objects_render_like_get_x_get_y(t_type):
+    np.random.seed(0)
+    trials, args = tasks.create_dataset_objects(task_args(t_type))
+    x, y = render_table(trials_to_table(trials))
+    for i, t in enumerate(trials):
+        assert np.allclose(x[i], t.get_x(), atol=1e-6)
+        assert np.allclose(y[i], t.get_y(), atol=1e-6)
+
+# the old pickles were written with tasks.py as __main__
+def test_old_pickles_load():
+    path = os.path.join(os.path.dirname(__file__), '..', 'datasets', 'rsg-100-150.pkl')
+    trials = load_pickle(path)[:50]
+    assert type(trials[0]) is tasks.RSG
+    x, y = render_table(trials_to_table(trials))
+    for i, t in enumerate(trials):
+        assert np.allclose(x[i], t.get_x(), atol=1e-6)
+        assert np.allclose(y[i], t.get_y(), atol=1e-6)
+
+# sampled tables: every row has the attributes of its Task class, so the Task's own get_x and get_y
+# work on it, and should give what the batch renderer does
+@pytest.mark.parametrize('t_type', T_TYPES)
+def test_sampled_render_like_get_x_get_y(t_type):
+    table, args = tasks.create_dataset(task_args(t_type))
+    TaskObj = tasks.get_task_obj(args)
+    x, y = render_table(table)
+    for i in range(len(table)):
+        row = table[i]
+        if TaskObj is tasks.DelayCopy:
+            # sampled tables keep the sines, which DelayCopy.__init__ sums into a pattern
+            x_r = np.arange(row.s_len)
+            row.pattern = np.sum(row.amps[:,:,None] * np.sin(1/row.freqs[:,:,None] * x_r), axis=1) / np.sqrt(row.n_freqs)
+        assert np.allclose(x[i], TaskObj.get_x(row), atol=1e-6)
+        assert np.allclose(y[i], TaskObj.get_y(row), atol=1e-6)
+
+# datasets only depend on the seed, not on how many processes sample them
+def test_sampling_is_seeded(monkeypatch):
+    monkeypatch.setattr(tasks, 'CHUNK_TRIALS', 7)
+    a, _ = tasks.create_dataset(task_args('rsg', n_trials=30, seed=3))
+    b, _ = tasks.create_dataset(update_args(task_args('rsg', n_trials=30, seed=3), Bunch(n_procs=2)))
+    c, _ = tasks.create_dataset(task_args('rsg', n_trials=30, seed=4))
+    assert a.columns.keys() == b.columns.keys()
+    for k in a.columns:
+        assert np.array_equal(a.columns[k], b.columns[k])
+    assert not np.array_equal(a.columns['rsg'], c.columns['rsg'])
+
+# rows of a table render once for both get_x and get_y, unless their inputs are noisy
+def test_rows_render_once(monkeypatch):
+    import columnar
+    table, args = tasks.create_dataset(task_args('rsg'))
+    calls = []
+    render = columnar.render_table
+    monkeypatch.setattr(columnar, 'render_table', lambda *a, **kw: calls.append(1) or render(*a, **kw))
+    row = table[0]
+    x, y = row.get_x(), row.get_y()
+    x[:] = 2
+    assert len(calls) == 1
+    assert not np.allclose(row.get_x(), x)
+    noisy = Bunch(m_noise=0, x_noise=.1)
+    assert not np.allclose(row.get_x(noisy), row.get_x(noisy))
+    assert np.allclose(row.get_y(noisy), y)
@@ -0,0 +1,55 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from helpers import FlatParams
+
+def model():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(3, 4), nn.Tanh(), nn.Linear(4, 2, bias=False))
+
+def test_params_are_copied_in():
+    net = model()
+    before = torch.cat([p.detach().reshape(-1).clone() for p in net.parameters()])
+    flat = FlatParams(net.parameters())
+    assert np.array_equal(flat.numpy(), before.numpy().astype(np.float64))
+
+# set() puts scipy's vector straight into the parameters, and grad_numpy() gives back the
+# gradients backward left there, in the same order
+def test_set_and_grad_round_trip():
+    net = model()
+    ref = model()
+    flat = FlatParams(net.parameters())
+    v = np.random.default_rng(0).normal(size=len(flat.data))
+    flat.set(v)
+    assert np.allclose(flat.numpy(), v, atol=1e-6)
+
+    ind = 0
+    with torch.no_grad():
+        for p in ref.parameters():
+            p.copy_(torch.from_numpy(v[ind:ind+p.numel()]).view_as(p))
+            ind += p.numel()
+    for m in [net, ref]:
+        m(torch.ones(5, 3)).pow(2).sum().backward()
+    flat_grad = flat.grad_numpy()
+    assert flat_grad.dtype == np.float64
+    assert np.allclose(flat_grad, torch.cat([p.grad.reshape(-1) for p in ref.parameters()]).numpy(), atol=1e-6)
+
+    # zero_grad clears them, and a second backward isn't added onto the first
+    flat.zero_grad()
+    assert not flat.grad.any()
+    net(torch.ones(5, 3)).pow(2).sum().backward()
+    assert np.allclose(flat.grad_numpy(), flat_grad, atol=1e-6)
+
+# gradients that were replaced instead of accumulated into, like OWM's, still come back
+def test_replaced_grads_are_copied_back():
+    net = model()
+    flat = FlatParams(net.parameters())
+    flat.zero_grad()
+    net(torch.ones(5, 3)).sum().backward()
+    p = next(net.parameters())
+    p.grad = torch.full_like(p, 7.)
+    assert np.all(flat.grad_numpy()[:p.numel()] == 7.)
+    # and the next zero_grad points the parameter back at the flat buffer
+    flat.zero_grad()
+    assert p.grad.data_ptr() == flat.grad.data_ptr()
@@ -0,0 +1,33 @@
+import os
+import json
+import pickle
+import numpy as np
+
+import run
+from columnar import load_pickle
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# testing earlier tasks together in one rollout gives the losses they get tested one at a time,
+# with tasks of different lengths and a loss (mse-e) that doesn't stop at the end of a trial
+def test_joint_losses_match_separate_tests(tmp_path):
+    trials = [t for t in load_pickle(os.path.join(ROOT, 'datasets', 'rsg-100-150.pkl')) if t.rsg[2] < 400]
+    for t in trials:
+        t.t_len = 400
+    short = os.path.join(tmp_path, 'rsg-short.pkl')
+    with open(short, 'wb') as f:
+        pickle.dump(trials, f)
+    with open(os.path.join(ROOT, 'datasets', 'configs', 'rsg-100-150.json')) as f:
+        config = json.load(f)
+    config.update(name='rsg-short', t_len=400)
+    os.makedirs(os.path.join(tmp_path, 'configs'))
+    with open(os.path.join(tmp_path, 'configs', 'rsg-short.json'), 'w') as f:
+        json.dump(config, f)
+    args = run.adjust_args(run.parse_args(['-d', os.path.join(ROOT, 'datasets', 'rsg-150-200.pkl'), short,
+        '-N', '30', '--sequential', '--loss', 'mse-e', '--test_size', '30', '--seed', '0', '--no_log']))
+    trainer = run.Trainer(args)
+    assert sorted(es[0][0].shape[2] for es in trainer.eval_sets) == [400, 600]
+    joint = dict(trainer.test_tasks(range(2)))
+    for i in range(2):
+        separate, _ = trainer.test(trainer.eval_sets[args.train_order[i]])
+        assert np.isclose(joint[i], separate, rtol=1e-5)
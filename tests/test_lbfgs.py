@@ -0,0 +1,34 @@
+import os
+import numpy as np
+import torch
+
+import run
+from helpers import render_rows
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the loss torch's lbfgs sees has to have the gradient it's given, for any batch size, or the
+# line search goes wrong. checked against central differences along a random direction
+def test_lbfgs_loss_gradient_matches_finite_differences():
+    for batch_size in [1, 3]:
+        args = run.adjust_args(run.parse_args([
+            '-d', os.path.join(ROOT, 'datasets', 'rsg-100-150.pkl'), '-N', '40', '--optimizer', 'lbfgs-pytorch',
+            '--batch_size', str(batch_size), '--seed', '0', '--res_seed', '1', '--network_seed', '2', '--no_log']))
+        trainer = run.Trainer(args)
+        x, y, trials = render_rows(trainer.train_set, range(6))
+
+        trainer.lbfgs_loss(x, y, trials)
+        d = [torch.randn(p.shape, generator=torch.Generator().manual_seed(i)) for i, p in enumerate(trainer.train_params)]
+        slope = sum((p.grad * dp).sum().item() for p, dp in zip(trainer.train_params, d))
+
+        eps = 1e-3
+        losses = []
+        for sign in [1, -1]:
+            with torch.no_grad():
+                for p, dp in zip(trainer.train_params, d):
+                    p.add_(sign * eps * dp)
+                losses.append(trainer.run_trial(x, y, trials, training=False))
+                for p, dp in zip(trainer.train_params, d):
+                    p.sub_(sign * eps * dp)
+        fd = (losses[0] - losses[1]) / (2 * eps)
+        assert np.isclose(fd, slope, rtol=1e-2), (batch_size, fd, slope)
@@ -0,0 +1,37 @@
+import os
+import numpy as np
+import torch
+
+import run
+from helpers import FlatParams, render_rows
+from parallel import ParallelClosure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the loss and gradient from worker processes are the ones the trainer gets by itself
+def test_parallel_closure_matches_serial():
+    args = run.adjust_args(run.parse_args([
+        '-d', os.path.join(ROOT, 'datasets', 'rsg-100-150.pkl'), '-N', '40', '--optimizer', 'lbfgs',
+        '--seed', '0', '--res_seed', '1', '--network_seed', '2', '--no_log']))
+    trainer = run.Trainer(args)
+    xs, ys, trials = render_rows(trainer.train_set, range(60))
+    flat = FlatParams(trainer.train_params, shared=True)
+
+    def serial(v):
+        flat.set(v)
+        trainer.net.reset()
+        flat.zero_grad()
+        loss = trainer.run_trial(xs, ys, trials, extras=False)
+        return loss, flat.grad_numpy()
+
+    pool = ParallelClosure(trainer.net, list(trainer.n_params), flat, xs, ys, trials, args, 3)
+    try:
+        rng = np.random.default_rng(0)
+        for i in range(2):
+            v = flat.numpy() + rng.normal(scale=.01, size=len(flat.data))
+            loss, grad = serial(v)
+            p_loss, p_grad = pool(v)
+            assert np.isclose(loss, p_loss, rtol=1e-5)
+            assert np.allclose(grad, p_grad, rtol=1e-4, atol=1e-4 * np.abs(grad).max())
+    finally:
+        pool.close()
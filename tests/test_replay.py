@@ -0,0 +1,26 @@
+import os
+
+import run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def contexts(loader, n_batches=3):
+    cs = set()
+    for i, (x, y, trials) in enumerate(loader):
+        cs.update(t.context for t in trials)
+        if i + 1 == n_batches:
+            break
+    return cs
+
+# persistent workers started before a task was added to the replay buffer still get to replay it
+def test_replay_reaches_persistent_workers():
+    configs = [os.path.join(ROOT, 'datasets', 'configs', f'{d}.json') for d in ['delaypro', 'delayanti']]
+    args = run.adjust_args(run.parse_args(['--stream', '-d'] + configs + [
+        '-N', '30', '--n_iters', '10', '--sequential', '--replay_size', '50', '--replay_ratio', '.5',
+        '--batch_size', '10', '--n_workers', '1', '--persistent_workers', '--seed', '0', '--no_log']))
+    trainer = run.Trainer(args)
+    # the second task's workers start with an empty buffer
+    assert contexts(trainer.train_loaders[1]) == {1}
+    trainer.next_task()
+    assert trainer.train_loader is trainer.train_loaders[1]
+    assert contexts(trainer.train_loader) == {0, 1}
@@ -0,0 +1,44 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUN = [sys.executable, os.path.join(ROOT, 'run.py'), '--stream', '-d', os.path.join(ROOT, 'datasets', 'configs', 'delaypro.json'),
+    '-N', '30', '--n_iters', '100', '--log_interval', '10', '--state_interval', '20',
+    '--seed', '0', '--res_seed', '1', '--network_seed', '2']
+
+def losses(run_dir):
+    csv = [f for f in os.listdir(run_dir) if f.startswith('losses_')][0]
+    with open(os.path.join(run_dir, csv), 'r') as f:
+        return f.read()
+
+# a run killed after saving its state and carried on with --resume logs the same losses as one
+# that wasn't stopped, including the ones it logged after the state and has to redo.
+# with --varpro, the ridge statistics and when M_ro is next solved have to carry on too
+@pytest.mark.parametrize('extra', [[], ['--varpro', '--varpro_interval', '3']])
+def test_sigkill_then_resume(tmp_path, extra):
+    subprocess.run(RUN + extra + ['--name', 'straight'], cwd=tmp_path, check=True, capture_output=True)
+
+    p = subprocess.Popen(RUN + extra + ['--name', 'killed'], cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    run_dir = os.path.join(tmp_path, 'logs', 'killed')
+    state_path = os.path.join(run_dir, 'state.pth')
+    try:
+        # wait for a saved state, then for a checkpoint after it that will have to be dropped
+        while not os.path.exists(state_path):
+            assert p.poll() is None, 'run ended before saving a state'
+            time.sleep(.02)
+        n_lines = losses(run_dir).count('\n')
+        while losses(run_dir).count('\n') == n_lines:
+            assert p.poll() is None, 'run ended before being killed'
+            time.sleep(.02)
+    finally:
+        p.send_signal(signal.SIGKILL)
+        p.wait()
+    assert losses(run_dir) != losses(os.path.join(tmp_path, 'logs', 'straight'))
+
+    subprocess.run([sys.executable, os.path.join(ROOT, 'run.py'), '--resume', run_dir], cwd=tmp_path, check=True, capture_output=True)
+    assert losses(run_dir) == losses(os.path.join(tmp_path, 'logs', 'straight'))
@@ -16,13 +16,17 @@ import csv
 import math
 import json
 import copy
+import time
 import pandas as pd
 
 # from network import BasicNetwork, Reservoir
-from network import M2Net
+from network import M2Net, compact_state_dict
 
-from utils import log_this, load_rb, get_config, update_args
-from helpers import get_optimizer, get_scheduler, get_criteria, create_loaders, collater
+from utils import log_this, load_rb, get_config, update_args, SampleStore, truncate_csv
+from helpers import get_optimizer, get_scheduler, get_criteria, create_loaders, render_eval_set, render_rows, Prefetcher, DataTimer, CheckpointWriter, atomic_save, get_rng_states, set_rng_states, FlatParams, RidgeReadout, join_eval_sets, ReplayBuffer, restart_workers
+from evaluator import AsyncEvaluator, joint_eval_losses
+from parallel import ParallelClosure
+from owm import OWM
 
 class Trainer:
     def __init__(self, args):
@@ -31,10 +35,11 @@ class Trainer:
 
         trains, tests = create_loaders(self.args.dataset, self.args, split_test=True, test_size=50)
 
+        # task being trained, which only ever changes when training sequentially
+        self.train_idx = 0
         if self.args.sequential:
             self.train_set, self.train_loaders = trains
             self.test_set, self.test_loaders = tests
-            self.train_idx = 0
             self.train_loader = self.train_loaders[self.args.train_order[self.train_idx]]
             self.test_loader = self.test_loaders[self.args.train_order[self.train_idx]]
         else:
@@ -47,11 +52,27 @@ class Trainer:
         if self.args.sequential:
             logging.info(f'Sequential training. Starting with task {self.train_idx}')
 
+        # rehearsal of earlier tasks, shared by every task's loader
+        self.replay = None
+        if self.args.sequential and hasattr(self.args, 'replay_size') and self.args.replay_size > 0:
+            self.replay = ReplayBuffer(self.args.replay_size, self.args.replay_ratio)
+            self.replay_rng = np.random.default_rng(self.args.seed)
+            for loader in self.train_loaders:
+                loader.dataset.replay = self.replay
+            logging.info(f'Replaying up to {self.args.replay_size} earlier trials, {self.args.replay_ratio:.0%} of every batch')
+
+        # test trials are rendered once and kept on the device, so every test sees the same trials
+        if self.args.sequential:
+            self.eval_sets = [self.make_eval_set(loader) for loader in self.test_loaders]
+            self.eval_set = self.eval_sets[self.args.train_order[self.train_idx]]
+        else:
+            self.eval_set = self.make_eval_set(self.test_loader)
+        n_eval = sum(len(b[0]) for b in self.eval_set)
+        logging.info(f'Evaluating on a fixed set of {n_eval} test trials')
+
         # self.net = BasicNetwork(self.args)
+        # hopfield net patterns (fixed_pts) are added by the reservoir itself
         self.net = M2Net(self.args)
-        # add hopfield net patterns
-        if hasattr(self.args, 'fixed_pts') and self.args.fixed_pts > 0:
-            self.net.reservoir.add_fixed_points(self.args.fixed_pts)
         self.net.to(self.device)
         
         # print('resetting network')
@@ -80,48 +101,96 @@ class Trainer:
             logging.info(f'  {k}')
 
         self.criteria = get_criteria(self.args)
-        self.optimizer = get_optimizer(self.args, self.train_params)
+        # variable projection: M_ro is solved for rather than trained, but still saved with the rest
+        self.varpro = hasattr(self.args, 'varpro') and self.args.varpro
+        opt_params = self.train_params
+        if self.varpro:
+            assert 'M_ro.weight' in self.n_params, 'varpro needs M_ro in train_parts'
+            assert self.args.out_act == 'none' and self.args.loss == ['mse'], 'varpro needs a linear readout and mse loss'
+            assert self.args.k == 0 and not self.args.net_fb, 'varpro needs full BPTT and no output feedback'
+            opt_params = [v for k, v in self.net.named_parameters() if k in self.n_params and not k.startswith('M_ro')]
+            self.readout = RidgeReadout(self.args)
+            self.varpro_ix = 0
+            logging.info(f'Solving M_ro by ridge regression every {self.args.varpro_interval} iterations')
+        self.optimizer = get_optimizer(self.args, opt_params)
         self.scheduler = get_scheduler(self.args, self.optimizer)
-        
+        self.owm = OWM() if self.args.owm else None
+        # earlier tasks' eval sets, joined together by test_tasks
+        self.joint_evals = {}
+
+        # where training is up to, and convergence testing. a saved state picks up from somewhere else
+        self.start_ix = 0
+        self.running_min_error = float('inf')
+        self.running_no_min = 0
+        # (epoch, batches into it), and the random state when that epoch started
+        self.position = (0, 0)
+        self.epoch_rng = None
+        self.resume_rng = None
+        self.state_path = self.args.state_path if hasattr(self.args, 'state_path') else None
+        self.state_interval = self.args.state_interval if hasattr(self.args, 'state_interval') else 0
+        if self.state_path is not None and os.path.exists(self.state_path):
+            self.load_state(self.state_path)
+
         self.log_interval = self.args.log_interval
+        self.timer = DataTimer()
         if not self.args.no_log:
             self.log = self.args.log
             self.run_id = self.args.log.run_id
-            self.vis_samples = []
-            self.csv_path = open(os.path.join(self.log.run_dir, f'losses_{self.run_id}.csv'), 'a')
+            losses_path = os.path.join(self.log.run_dir, f'losses_{self.run_id}.csv')
+            # a resumed run carries on writing the same files, minus anything logged after its state was saved
+            truncate_csv(losses_path, self.start_ix)
+            new_csv = not os.path.exists(losses_path) or os.path.getsize(losses_path) == 0
+            self.csv_path = open(losses_path, 'a')
             self.writer = csv.writer(self.csv_path, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-            self.writer.writerow(['ix', 'train_loss', 'test_loss'])
-            self.plot_checkpoint_path = os.path.join(self.log.run_dir, f'checkpoints_{self.run_id}.pkl')
+            if new_csv:
+                self.writer.writerow(['ix', 'train_loss', 'test_loss'])
+            if self.args.log_checkpoint_samples:
+                self.sample_store = SampleStore(os.path.join(self.log.run_dir, f'samples_{self.run_id}'), max_ix=self.start_ix)
             self.save_model_path = os.path.join(self.log.run_dir, f'model_{self.run_id}.pth')
+            self.ckpt_writer = CheckpointWriter()
+
+    def make_eval_set(self, loader):
+        eval_set = []
+        n = self.args.test_size if hasattr(self.args, 'test_size') and self.args.test_size >= 0 else None
+        size = self.args.eval_size if hasattr(self.args, 'eval_size') else 200
+        for x, y, trials in render_eval_set(loader, size, n):
+            eval_set.append((x.to(self.device), y.to(self.device), trials))
+        return eval_set
+
+    # trained parameters only, unless asked for everything
+    def model_state(self):
+        if hasattr(self.args, 'full_models') and self.args.full_models:
+            return self.net.state_dict()
+        return compact_state_dict(self.net, self.n_params)
 
     def log_model(self, ix=0, name=None):
         # if we want to save a particular name, just do it and leave
         if name is not None:
-            model_path = os.path.join(self.log.run_dir, name)
-            if os.path.exists(model_path):
-                os.remove(model_path)
-            torch.save(self.net.state_dict(), model_path)
+            self.ckpt_writer.save(self.model_state(), os.path.join(self.log.run_dir, name))
             return
         # saving all checkpoints takes too much space so we just save one model at a time, unless we explicitly specify it
         if self.args.log_checkpoint_models:
             self.save_model_path = os.path.join(self.log.checkpoint_dir, f'model_{ix}.pth')
-        elif os.path.exists(self.save_model_path):
-            os.remove(self.save_model_path)
-        torch.save(self.net.state_dict(), self.save_model_path)
+        self.ckpt_writer.save(self.model_state(), self.save_model_path)
+
+    # wait for checkpoints still being written
+    def close_log(self):
+        self.ckpt_writer.close()
+        logging.info(f'Checkpoints: {self.ckpt_writer.summary()}')
+        if self.args.log_checkpoint_samples:
+            self.sample_store.close()
+        self.csv_path.close()
 
-    def log_checkpoint(self, ix, x, y, z, train_loss, test_loss):
+    def log_checkpoint(self, ix, x, y, z, train_loss, test_loss, save_model=True):
         self.writer.writerow([ix, train_loss, test_loss])
         self.csv_path.flush()
 
-        self.log_model(ix)
+        if save_model:
+            self.log_model(ix)
 
         # we can save individual samples at each checkpoint, that's not too bad space-wise
         if self.args.log_checkpoint_samples:
-            self.vis_samples.append([ix, x, y, z, train_loss, test_loss])
-            if os.path.exists(self.plot_checkpoint_path):
-                os.remove(self.plot_checkpoint_path)
-            with open(self.plot_checkpoint_path, 'wb') as f:
-                pickle.dump(self.vis_samples, f)
+            self.sample_store.append(ix, x, y, z, train_loss, test_loss)
 
     # runs an iteration where we want to match a certain trajectory
     def run_trial(self, x, y, trial, training=True, extras=False):
@@ -153,16 +222,9 @@ class Trainer:
                 trial_loss += k_loss.detach().item()
                 if training:
                     k_loss.backward()
-                    # strategies for continual learning that involve modifying gradients
-                    if self.args.sequential and self.train_idx > 0:
-                        if self.args.owm:
-                            # orthogonal weight modification
-                            self.net.M_u.weight.grad = self.P_u @ self.net.M_u.weight.grad @ self.P_s
-                            self.net.M_ro.weight.grad = self.P_z @ self.net.M_ro.weight.grad @ self.P_v
-                            if self.args.ff_bias:
-                                self.net.M_u.bias.grad = self.P_u @ self.net.M_u.bias.grad
-                                self.net.M_ro.bias.grad = self.P_z @ self.net.M_ro.bias.grad
-                        elif self.args.swt:
+                    # strategies for continual learning that involve modifying gradients. OWM is below
+                    if self.args.sequential and self.train_idx > 0 and not self.args.owm:
+                        if self.args.swt:
                             # keeping sensory and output weights constant after learning first task
                             self.net.M_u.weight.grad[:,:self.args.L] = 0
                             self.net.M_ro.weight.grad[:] = 0
@@ -175,6 +237,10 @@ class Trainer:
 
         trial_loss /= x.shape[0]
 
+        # orthogonal weight modification, once all the gradient's been accumulated
+        if training and self.owm is not None:
+            self.owm.project(self.net)
+
         if extras:
             net_us = torch.stack(us, dim=2)
             net_vs = torch.stack(vs, dim=2)
@@ -188,8 +254,12 @@ class Trainer:
         return trial_loss
 
     def train_iteration(self, x, y, trial, ix_callback=None):
+        if self.varpro:
+            return self.varpro_iteration(x, y, trial)
         self.optimizer.zero_grad()
         trial_loss, etc = self.run_trial(x, y, trial, extras=True)
+        if self.owm is not None:
+            self.owm.accumulate({'s': x, 'u': etc['us'], 'v': etc['vs'], 'z': etc['outs']})
 
         if ix_callback is not None:
             ix_callback(trial_loss, etc)
@@ -204,60 +274,270 @@ class Trainer:
         }
         return trial_loss, etc
 
-    def test(self):
-        with torch.no_grad():
-            x, y, trials = next(iter(self.test_loader))
-            x, y = x.to(self.device), y.to(self.device)
-            loss, etc = self.run_trial(x, y, trials, training=False, extras=True)
+    # one run through the reservoir for the features, M_ro solved from them (every varpro_interval
+    # iterations), then the outputs and loss with that M_ro, and a step for everything else.
+    # since M_ro is optimal for these features, this is the gradient of the loss with M_ro projected out
+    def varpro_iteration(self, x, y, trial):
+        self.optimizer.zero_grad()
+        self.net.reset(self.args.res_x_init, device=self.device)
+        us, vs, hs = [], [], []
+        for j in range(x.shape[2]):
+            _, etc = self.net(x[:,:,j], extras=True)
+            us.append(etc['u'])
+            vs.append(etc['v'])
+            hs.append(self.net.m2_act(etc['v']))
+        h = torch.stack(hs, dim=2)
+
+        if self.varpro_ix % self.args.varpro_interval == 0:
+            t_lens = torch.as_tensor([t.t_len for t in trial], device=self.device)
+            self.readout.fit(self.net.M_ro, h, y, t_lens)
+        self.varpro_ix += 1
+
+        outs = self.net.M_ro(h.permute(0, 2, 1)).permute(0, 2, 1)
+        loss = 0.
+        for c in self.criteria:
+            loss += c(outs, y, i=trial, t_ix=0)
+        loss.backward()
+        self.optimizer.step()
 
         etc = {
             'ins': x,
             'goals': y,
-            'us': etc['us'].detach(),
-            'vs': etc['vs'].detach(),
-            'outs': etc['outs'].detach()
+            'us': torch.stack(us, dim=2).detach(),
+            'vs': torch.stack(vs, dim=2).detach(),
+            'outs': outs.detach()
         }
-
-        return loss, etc
+        return loss.item() / x.shape[0], etc
+
+    # loss over the whole fixed evaluation set. etc is from its first batch
+    def test(self, eval_set=None):
+        if eval_set is None:
+            eval_set = self.eval_set
+        total_loss = 0.
+        n_trials = 0
+        with torch.no_grad():
+            for i, (x, y, trials) in enumerate(eval_set):
+                loss, b_etc = self.run_trial(x, y, trials, training=False, extras=True)
+                # run_trial gives the mean loss per trial in the batch
+                total_loss += loss * len(x)
+                n_trials += len(x)
+                if i == 0:
+                    etc = {
+                        'ins': x,
+                        'goals': y,
+                        'us': b_etc['us'].detach(),
+                        'vs': b_etc['vs'].detach(),
+                        'outs': b_etc['outs'].detach()
+                    }
+
+        return total_loss / n_trials, etc
 
     # helper function for sequential training, for testing performance on all tasks
+    # all of them in one batch, so it costs a single rollout however many tasks there are
     def test_tasks(self, ids):
-        losses = []
-        for i in ids:
-            self.test_loader = self.test_loaders[self.args.train_order[i]]
-            loss, _ = self.test()
-            losses.append((i, loss))
-        self.test_loader = self.test_loaders[self.train_idx]
-        return losses
-
-    def update_P(self, S, states):
-        S_new = torch.einsum('ijk,ilk->jl',states,states) / states.shape[0] / states.shape[2]
-        S_avg = (S * self.train_idx + S_new) / (self.train_idx + 1)
-        alpha = 1e-3
-        P = torch.inverse(S_avg / alpha + torch.eye(S_avg.shape[0]))
-        return P, S_avg
+        ids = list(ids)
+        if len(ids) == 0:
+            return []
+        key = tuple(self.args.train_order[i] for i in ids)
+        if key not in self.joint_evals:
+            # the same tasks get tested until the next one's trained, so only the latest is kept
+            self.joint_evals = {key: join_eval_sets([self.eval_sets[c] for c in key])}
+        return list(zip(ids, joint_eval_losses(self.net, self.args, self.criteria, self.joint_evals[key])))
+
+    # the tests that are due at a checkpoint, as (task number, eval set index) pairs. the first is the task being trained
+    def due_tests(self):
+        if not self.args.sequential:
+            return [(0, 0)]
+        tests = [(self.train_idx, self.args.train_order[self.train_idx])]
+        tests.extend((i, self.args.train_order[i]) for i in range(self.train_idx))
+        return tests
+
+    # test at a checkpoint, the same way the evaluation worker does
+    def evaluate(self, ix, train_loss):
+        test_loss, _ = self.test()
+        task_losses = []
+        if self.args.sequential:
+            task_losses = self.test_tasks(ids=range(self.train_idx))
+        return {
+            'ix': ix,
+            'train_idx': self.train_idx,
+            'train_loss': train_loss,
+            'test_loss': test_loss,
+            'task_losses': task_losses,
+            'best': None
+        }
+
+    # log a checkpoint's test results, and decide whether to move on. returns 'switch', 'end' or None
+    # results can arrive late when testing asynchronously, so anything from an earlier task is only logged,
+    # and with decide=False the best loss is kept track of but nothing else changes
+    def handle_result(self, result, decide=True):
+        ix, train_loss, test_loss = result['ix'], result['train_loss'], result['test_loss']
+        ins, goals, z, data_str = self.pending.pop(ix)
+        log_arr = [
+            f'*{ix}',
+            f'train {train_loss:.3f}',
+            f'test {test_loss:.3f}'
+        ]
+        for i, loss in result['task_losses']:
+            log_arr.append(f't{i}: {loss:.3f}')
+        log_arr.append(data_str)
+        log_str = '\t| '.join(log_arr)
+        logging.info(log_str)
+
+        if not self.args.no_log:
+            self.log_checkpoint(ix, ins, goals, z, train_loss, test_loss, save_model=result['best'] is None)
+
+        if result['train_idx'] != self.train_idx:
+            return None
+
+        # if training sequentially, move on to the next task
+        if decide and self.args.sequential and test_loss < self.args.seq_threshold:
+            return 'switch'
+
+        # convergence based on no avg loss decrease after patience samples
+        if test_loss < self.running_min_error:
+            self.running_no_min = 0
+            self.running_min_error = test_loss
+            # the evaluation worker saves its own best model
+            if not self.args.no_log and result['best'] is None:
+                self.log_model(name='model_best.pth')
+        else:
+            self.running_no_min += self.log_interval
+        if decide and self.running_no_min > self.args.patience:
+            logging.info(f'iteration {ix}: no min for {self.args.patience} samples. ending')
+            return 'end'
+        return None
+
+    # done with the current task in sequential training. returns whether all tasks are done
+    def next_task(self):
+        logging.info(f'Successfully trained task {self.train_idx}...')
+
+        losses = self.test_tasks(ids=range(self.train_idx + 1))
+        for i, loss in losses:
+            logging.info(f'...loss on task {i}: {loss:.3f}')
+
+        # orthogonal weight modification of M_u and M_ro, from everything this task trained on
+        if self.owm is not None:
+            self.owm.end_task()
+            logging.info(f'...updated projection matrices for OWM')
+
+        if self.replay is not None:
+            self.replay.add_task(self.train_loader.dataset, self.args.train_order[self.train_idx], self.replay_rng)
+            for loader in self.train_loaders:
+                restart_workers(loader)
+
+        # done processing prior task, move on to the next one or quit
+        self.train_idx += 1
+        if self.train_idx == len(self.args.train_order):
+            logging.info(f'...done training all tasks! ending')
+            return True
+        logging.info(f'...moving on to task {self.train_idx}.')
+        self.select_task()
+        self.running_min_error = float('inf')
+        self.running_no_min = 0
+        return False
+
+    # data for the task being trained, in sequential training
+    def select_task(self):
+        self.train_loader = self.train_loaders[self.args.train_order[self.train_idx]]
+        self.test_loader = self.test_loaders[self.args.train_order[self.train_idx]]
+        self.eval_set = self.eval_sets[self.args.train_order[self.train_idx]]
+
+    # everything needed to carry on training later exactly as if it hadn't stopped, with --state_path or --resume
+    def save_state(self, path, ix):
+        state = {
+            'ix': ix,
+            'model': self.model_state(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': None if self.scheduler is None else self.scheduler.state_dict(),
+            'train_idx': self.train_idx,
+            'running_min_error': self.running_min_error,
+            'running_no_min': self.running_no_min,
+            'position': self.position,
+            'epoch_rng': self.epoch_rng,
+            'rng': get_rng_states(),
+            'owm': None if self.owm is None else self.owm.state_dict(),
+            'replay': None if self.replay is None else (self.replay.state_dict(), self.replay_rng.bit_generator.state),
+            'varpro': (self.readout.state_dict(), self.varpro_ix) if self.varpro else None
+        }
+        # in the background if we're logging anyway
+        if not self.args.no_log:
+            self.ckpt_writer.save(state, path)
+        else:
+            atomic_save(state, path)
+
+    def load_state(self, path):
+        state = torch.load(path, map_location=self.device)
+        self.net.load_checkpoint(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.start_ix = state['ix']
+        self.running_min_error = state['running_min_error']
+        self.running_no_min = state['running_no_min']
+        self.train_idx = state['train_idx']
+        # states from before these were saved start at the beginning of an epoch
+        if 'position' in state:
+            self.position = tuple(state['position'])
+            self.epoch_rng = state['epoch_rng']
+            self.resume_rng = state['rng']
+            if self.owm is not None and state['owm'] is not None:
+                self.owm.load_state_dict(state['owm'])
+            if self.replay is not None and state.get('replay') is not None:
+                self.replay.load_state_dict(state['replay'][0])
+                self.replay_rng.bit_generator.state = state['replay'][1]
+            if self.varpro and state.get('varpro') is not None:
+                self.readout.load_state_dict(state['varpro'][0])
+                self.varpro_ix = state['varpro'][1]
+        if self.args.sequential:
+            self.select_task()
+        logging.info(f'Carrying on from iteration {self.start_ix} of {path}')
 
     def train(self, ix_callback=None):
-        ix = 0
-        # for convergence testing
-        running_min_error = float('inf')
-        running_no_min = 0
+        ix = self.start_ix
 
         running_loss = 0.0
         ending = False
 
-        # for OWM
-        if self.args.owm:
-            S_s = 0
-            S_u = 0
-            S_v = 0
-            S_z = 0
-
-        for e in range(self.args.n_epochs):
-            for epoch_idx, (x, y, info) in enumerate(self.train_loader):
+        # checkpoints waiting on their test results
+        self.pending = {}
+        evaluator = None
+        if hasattr(self.args, 'async_eval') and self.args.async_eval:
+            eval_sets = self.eval_sets if self.args.sequential else [self.eval_set]
+            run_dir = None if self.args.no_log else self.log.run_dir
+            params = {k: v for k, v in self.net.named_parameters() if k in self.n_params}
+            evaluator = AsyncEvaluator(self.net, params, eval_sets, self.args, run_dir, n_slots=self.args.eval_lag, best=(self.train_idx, self.running_min_error))
+            logging.info(f'Testing in a separate process, at most {self.args.eval_lag} tests behind')
+
+        start_epoch, skip = self.position
+        for e in range(start_epoch, self.args.n_epochs):
+            # resuming partway through an epoch: start it again the same way, and skip the batches
+            # that were already trained on. the batches only come out the same if they're drawn the same
+            if self.resume_rng is None:
+                skip = 0
+            elif skip == 0:
+                set_rng_states(self.resume_rng)
+                self.resume_rng = None
+            else:
+                set_rng_states(self.epoch_rng)
+            self.epoch_rng = get_rng_states()
+            # without workers, batches can still be made in the background
+            loader = self.train_loader
+            n_workers = self.args.n_workers if hasattr(self.args, 'n_workers') else 0
+            prefetch = self.args.prefetch if hasattr(self.args, 'prefetch') else 0
+            if n_workers == 0 and prefetch > 0:
+                loader = Prefetcher(loader, prefetch, hasattr(self.args, 'pin_memory') and self.args.pin_memory)
+            for epoch_idx, (x, y, info) in enumerate(self.timer.wrap(loader)):
+                if epoch_idx < skip:
+                    # numpy is left alone, it's been drawing the batches ahead of training all along
+                    if epoch_idx == skip - 1:
+                        set_rng_states(self.resume_rng, numpy=False)
+                        self.resume_rng = None
+                    continue
                 ix += 1
+                self.position = (e, epoch_idx + 1)
 
-                x, y = x.to(self.device), y.to(self.device)
+                x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
                 iter_loss, etc = self.train_iteration(x, y, info, ix_callback=ix_callback)
 
                 if iter_loss == -1:
@@ -270,128 +550,121 @@ class Trainer:
                 if ix % self.log_interval == 0:
                     z = etc['outs'].cpu().numpy().squeeze()
                     train_loss = running_loss / self.log_interval
-                    test_loss, test_etc = self.test()
-                    log_arr = [
-                        f'*{ix}',
-                        f'train {train_loss:.3f}',
-                        f'test {test_loss:.3f}'
-                    ]
-                    if self.args.sequential:
-                        losses = self.test_tasks(ids=range(self.train_idx))
-                        for i, loss in losses:
-                            log_arr.append(f't{i}: {loss:.3f}')
-                    log_str = '\t| '.join(log_arr)
-                    logging.info(log_str)
-
-                    if not self.args.no_log:
-                        self.log_checkpoint(ix, etc['ins'].cpu().numpy(), etc['goals'].cpu().numpy(), z, train_loss, test_loss)
                     running_loss = 0.0
-
-                    # if training sequentially, move on to the next task
-                    # if doing OWM-like updates, do them here
-                    if self.args.sequential and test_loss < self.args.seq_threshold:
-                        logging.info(f'Successfully trained task {self.train_idx}...')
-                        
-                        losses = self.test_tasks(ids=range(self.train_idx + 1))
-                        for i, loss in losses:
-                            logging.info(f'...loss on task {i}: {loss:.3f}')
-
-                        # orthogonal weight modification of M_u and M_ro
-                        if self.args.owm:
-                            # 0th dimension is test batch size, 2nd dimension is number of timesteps
-                            # 1st dimension is the actual vector representation
-                            self.P_s, S_s = self.calc_P(S_s, test_etc['ins'])
-                            self.P_u, S_u = self.update_P(S_u, test_etc['us'])
-                            self.P_v, S_v = self.update_P(S_v, test_etc['vs'])
-                            self.P_z, S_z = self.update_P(S_z, test_etc['outs'])
-                            logging.info(f'...updated projection matrices for OWM')
-
-                        # done processing prior task, move on to the next one or quit
-                        self.train_idx += 1
-                        if self.train_idx == len(self.args.train_order):
-                            ending = True
-                            logging.info(f'...done training all tasks! ending')
-                            break
-                        logging.info(f'...moving on to task {self.train_idx}.')
-                        self.train_loader = self.train_loaders[self.args.train_order[self.train_idx]]
-                        self.test_loader = self.test_loaders[self.args.train_order[self.train_idx]]
-                        running_min_error = float('inf')
-                        running_no_min = 0
-                        break
-
-                    # convergence based on no avg loss decrease after patience samples
-                    if test_loss < running_min_error:
-                        running_no_min = 0
-                        running_min_error = test_loss
+                    # per-iteration data time, and how much of it the training loop actually waited for
+                    wait_t, data_t, iter_t, hidden = self.timer.summary()
+                    data_str = f'data {data_t:.1f}ms, wait {wait_t:.1f}/{iter_t:.1f}ms ({hidden:.0%} hidden)'
+                    self.timer.reset()
+                    self.pending[ix] = (etc['ins'].cpu().numpy(), etc['goals'].cpu().numpy(), z, data_str)
+
+                    if evaluator is not None:
+                        # the model is saved now, and logged with its losses once they arrive
                         if not self.args.no_log:
-                            self.log_model(name='model_best.pth')
+                            self.log_model(ix)
+                        evaluator.submit(ix, self.train_idx, self.due_tests(), train_loss)
+                        results = evaluator.poll()
                     else:
-                        running_no_min += self.log_interval
-                    if running_no_min > self.args.patience:
-                        logging.info(f'iteration {ix}: no min for {self.args.patience} samples. ending')
+                        results = [self.evaluate(ix, train_loss)]
+
+                    action = None
+                    for result in results:
+                        action = self.handle_result(result, decide=action is None) or action
+
+                    if action == 'switch':
+                        ending = self.next_task()
+                        break
+                    elif action == 'end':
                         ending = True
+                    elif self.state_path is not None and self.state_interval > 0 and ix % self.state_interval == 0:
+                        self.save_state(self.state_path, ix)
+                if hasattr(self.args, 'n_iters') and self.args.n_iters is not None and ix >= self.args.n_iters:
+                    logging.info(f'iteration {ix}: reached iteration budget. ending')
+                    ending = True
                 if ending:
                     break
+            # the next task, or just the next epoch, starts from the beginning
+            if not ending:
+                self.position = (e + 1, 0)
+            # a run that stops here has to carry on from before the scheduler steps
+            if ending and self.state_path is not None:
+                self.save_state(self.state_path, ix)
             logging.info(f'Finished dataset epoch {e+1}')
             if self.scheduler is not None:
                 self.scheduler.step()
             if ending:
                 break
 
-        if not self.args.no_log and self.args.log_checkpoint_samples:
-            # for later visualization of outputs over timesteps
-            with open(self.plot_checkpoint_path, 'wb') as f:
-                pickle.dump(self.vis_samples, f)
+        if evaluator is not None:
+            # tests still in flight are logged, but don't change anything
+            for result in evaluator.close():
+                self.handle_result(result, decide=False)
+            logging.info(f'Waited {evaluator.wait_time:.1f}s in total for the evaluation worker')
 
-            self.csv_path.close()
+        if not ending and self.state_path is not None:
+            self.save_state(self.state_path, ix)
+
+        if not self.args.no_log:
+            self.close_log()
 
-        logging.info(f'END | iterations: {(ix // self.log_interval) * self.log_interval} | best loss: {running_min_error}')
-        return running_min_error, ix
+        logging.info(f'END | iterations: {(ix // self.log_interval) * self.log_interval} | best loss: {self.running_min_error}')
+        return self.running_min_error, ix
 
 
     def optimize_lbfgs(self):
-        xs, ys, trials = collater(self.train_set[:1000])
+        xs, ys, trials = render_rows(self.train_set, range(min(1000, len(self.train_set))))
         xs, ys = xs.to(self.device), ys.to(self.device)
 
-        # xs_test, ys_test, trials_test = collater(self.test_set)
+        # xs_test, ys_test, trials_test = self.test_set[:]
         # so that the callback for scipy.optimize.minimize knows what step it is on
         self.scipy_ix = 0
         vis_samples = []
 
+        # the trained parameters live in one flat buffer that scipy's vectors are copied straight into
+        n_procs = self.args.lbfgs_procs if hasattr(self.args, 'lbfgs_procs') else 0
+        flat = FlatParams(self.train_params, shared=n_procs > 0)
+
         # this is what happens every iteration
         # run through all examples (x, y) and get loss, gradient
         def closure(v):
-            # setting the parameters in the network with the new values in v
-            ind = 0
-            for k,nums in self.n_params.items():
-                # nums[0] is shape, nums[1] is number of elements
-                weight = v[ind:ind+nums[1]].reshape(nums[0])
-                self.net.state_dict()[k][:] = torch.Tensor(weight)
-                ind += nums[1]
+            flat.set(v)
 
             # res state starting from same random seed for each iteration
             self.net.reset()
-            self.net.zero_grad()
+            flat.zero_grad()
 
-            # total_loss = torch.tensor(0.)
             total_loss = self.run_trial(xs, ys, trials, extras=False)
-            # total_loss.backward()
-
-            # turn param grads into list
-            grad_list = []
-            for v in self.train_params:
-                grad = v.grad.clone().numpy().reshape(-1)
-                grad_list.append(grad)
-            vec = np.concatenate(grad_list)
-            post = np.float64(vec)
 
-            return total_loss, post
+            return total_loss, flat.grad_numpy()
+
+        # or split the trials up between worker processes
+        pool = None
+        if n_procs > 0:
+            assert self.device == torch.device('cpu') and self.args.k == 0, 'parallel lbfgs is cpu and full BPTT only'
+            # the workers only compute plain gradients
+            assert not self.args.owm and not (hasattr(self.args, 'swt') and self.args.swt), 'parallel lbfgs can\'t do OWM or SWT'
+            # every call sends a request to each worker and waits on all of them, so it only pays off when
+            # each worker has a core to itself and enough work per call: with N in the hundreds or more,
+            # not N = 40. otherwise it's slower than doing it here
+            n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+            if n_procs > n_cores:
+                logging.warning(f'{n_procs} lbfgs processes but only {n_cores} cores, this will be slower than --lbfgs_procs 0')
+            pool = ParallelClosure(self.net, list(self.n_params), flat, xs, ys, trials, self.args, n_procs)
+            closure = pool
+            logging.info(f'Computing the loss and gradient in {n_procs} processes')
+
+        # L-BFGS-B ends each line search by evaluating the point it accepts, so the last loss
+        # is the loss at the point the callback gets, for --target_loss
+        evaluate = closure
+        def closure(v):
+            self.lbfgs_loss, grad = evaluate(v)
+            return self.lbfgs_loss, grad
 
         # callback just does logging
         def callback(xk):
+            self.scipy_ix += 1
+            self.check_target(self.lbfgs_loss, self.scipy_ix)
             if self.args.no_log:
                 return
-            self.scipy_ix += 1
             if self.scipy_ix % self.log_interval == 0:
                 sample_n = random.randrange(1000)
 
@@ -427,10 +700,8 @@ class Trainer:
                     logging.info(f'iteration {self.scipy_ix}\t| loss {loss:.3f}')
 
         # getting the initial values to put into the algorithm
-        init_list = []
-        for v in self.train_params:
-            init_list.append(v.detach().clone().numpy().reshape(-1))
-        init = np.concatenate(init_list)
+        init = flat.numpy()
+        self.lbfgs_start = time.time()
 
         optim_options = {
             'iprint': self.log_interval,
@@ -438,15 +709,105 @@ class Trainer:
             # 'ftol': 1e-16
         }
         optim = minimize(closure, init, method='L-BFGS-B', jac=True, callback=callback, options=optim_options)
+        if pool is not None:
+            pool.close()
+        self.report_target(optim.nit)
 
         error_final = optim.fun
         n_iters = optim.nit
 
         if not self.args.no_log:
             self.log_model(name='model_final.pth')
-            if self.args.log_checkpoint_samples:
-                with open(self.plot_checkpoint_path, 'wb') as f:
-                    pickle.dump(self.vis_samples, f)
-            self.csv_path.close()
+            self.close_log()
 
         return error_final, n_iters
+
+    # torch's own L-BFGS with a strong wolfe line search, on the same trials as optimize_lbfgs. they're
+    # rendered once and stay on the device. with --lbfgs_batch, each step uses the next chunk of them,
+    # starting over with no history since it's a different objective.
+    # every step runs log_interval iterations, then it's tested and logged like the other optimizers
+    def optimize_lbfgs_torch(self):
+        xs, ys, trials = render_rows(self.train_set, range(min(1000, len(self.train_set))))
+        xs, ys = xs.to(self.device), ys.to(self.device)
+        n = len(xs)
+        batch_size = n
+        if hasattr(self.args, 'lbfgs_batch') and self.args.lbfgs_batch is not None:
+            batch_size = min(n, self.args.lbfgs_batch)
+
+        ix = 0
+        step = 0
+        train_loss = float('inf')
+        self.lbfgs_start = time.time()
+        while ix < self.args.maxiter:
+            lo = (step * batch_size) % n
+            x, y, trial = xs[lo:lo+batch_size], ys[lo:lo+batch_size], trials[lo:lo+batch_size]
+            if batch_size < n:
+                self.optimizer.state.clear()
+            step += 1
+
+            def closure():
+                return self.lbfgs_loss(x, y, trial)
+
+            # the last step only goes as far as the iteration budget
+            group = self.optimizer.param_groups[0]
+            group['max_iter'] = min(self.log_interval, self.args.maxiter - ix)
+            # up to 20 evaluations per line search, like scipy's maxls
+            group['max_eval'] = group['max_iter'] * 20
+            n_iter = self.optimizer.state[self.train_params[0]].get('n_iter', 0)
+            self.optimizer.step(closure)
+            done = self.optimizer.state[self.train_params[0]]['n_iter'] - n_iter
+            # no iterations in a whole step means it's converged
+            if done == 0:
+                logging.info(f'iteration {ix}: converged. ending')
+                break
+            ix += done
+
+            # the line search's last evaluation isn't always where it ended up
+            with torch.no_grad():
+                train_loss = self.run_trial(x, y, trial, training=False)
+            self.check_target(train_loss, ix)
+
+            loss, etc = self.test()
+            if loss < self.running_min_error:
+                self.running_min_error = loss
+                if not self.args.no_log:
+                    self.log_model(name='model_best.pth')
+            if not self.args.no_log:
+                self.log_checkpoint(ix, etc['ins'].cpu().numpy(), etc['goals'].cpu().numpy(), etc['outs'].cpu().numpy(), train_loss, loss)
+            logging.info(f'iteration {ix}\t| train {train_loss:.3f}\t| test {loss:.3f}\t| {time.time() - self.lbfgs_start:.1f}s')
+
+        self.report_target(ix)
+        if not self.args.no_log:
+            self.log_model(name='model_final.pth')
+            self.close_log()
+
+        return train_loss, ix
+
+    # the closure for torch's lbfgs. run_trial gives the loss divided by the number of trials, but
+    # its gradient is of the loss before that; the line search needs them to agree
+    def lbfgs_loss(self, x, y, trial):
+        self.optimizer.zero_grad()
+        loss = self.run_trial(x, y, trial)
+        for p in self.train_params:
+            if p.grad is not None:
+                p.grad.div_(len(x))
+        return loss
+
+    # how long lbfgs took to get the mean training loss per trial down to --target_loss, to compare the
+    # scipy and torch versions. reported at the end of both, whether or not it's logging
+    def check_target(self, loss, ix):
+        target = self.args.target_loss if hasattr(self.args, 'target_loss') else None
+        if target is None or loss > target or hasattr(self, 'target_time'):
+            return
+        self.target_time = time.time() - self.lbfgs_start
+        self.target_ix = ix
+
+    def report_target(self, ix):
+        target = self.args.target_loss if hasattr(self.args, 'target_loss') else None
+        if target is None:
+            return
+        total = time.time() - self.lbfgs_start
+        if hasattr(self, 'target_time'):
+            logging.info(f'{self.args.optimizer}: reached target loss {target} at iteration {self.target_ix}, after {self.target_time:.1f}s ({ix} iterations in {total:.1f}s)')
+        else:
+            logging.info(f'{self.args.optimizer}: didn\'t reach target loss {target} ({ix} iterations in {total:.1f}s)')
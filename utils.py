@@ -8,6 +8,7 @@ import logging
 import time
 import json
 import csv
+import fcntl
 import pickle
 import copy
 import pdb
@@ -50,8 +51,10 @@ def update_args(args, new_args, overwrite=True, to_bunch=True):
 
 
 # produce run id and create log directory
-def log_this(config, log_dir, log_name=None, checkpoints=False, use_id=True):
-    run_id = str(int(time.time() * 100))[-7:]
+# passing a run_id carries on logging to that run's files
+def log_this(config, log_dir, log_name=None, checkpoints=False, use_id=True, run_id=None):
+    if run_id is None:
+        run_id = str(int(time.time() * 100))[-7:]
     config.run_id = run_id
     print('\n=== Logging ===', flush=True)
     
@@ -112,6 +115,83 @@ def load_rb(path):
         qs = pickle.load(f)
     return qs
 
+# samples from every checkpoint, for visualizing training. written as they come so nothing is kept in memory:
+# one .npz of x, y, z per checkpoint, plus an index csv of ix, train_loss, test_loss
+class SampleStore:
+    def __init__(self, path, max_ix=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # samples from after max_ix were logged by a run that's being resumed from before them
+        if max_ix is not None:
+            truncate_csv(os.path.join(path, 'index.csv'), max_ix, header=False)
+        self.index = open(os.path.join(path, 'index.csv'), 'a')
+        self.writer = csv.writer(self.index)
+
+    def append(self, ix, x, y, z, train_loss, test_loss):
+        np.savez(os.path.join(self.path, f'{ix}.npz'), x=x, y=y, z=z)
+        # index last, so every row in it has its arrays
+        self.writer.writerow([ix, train_loss, test_loss])
+        self.index.flush()
+
+    def close(self):
+        self.index.close()
+
+# reads a SampleStore lazily. items are [ix, x, y, z, train_loss, test_loss], like the old pickled lists
+class CheckpointSamples:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.csv'), 'r') as f:
+            self.index = [(int(r[0]), float(r[1]), float(r[2])) for r in csv.reader(f)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        ix, train_loss, test_loss = self.index[i]
+        with np.load(os.path.join(self.path, f'{ix}.npz')) as data:
+            return [ix, data['x'], data['y'], data['z'], train_loss, test_loss]
+
+# checkpoint samples from either a sample store folder or an old pickle
+def load_samples(path):
+    if os.path.isdir(path):
+        return CheckpointSamples(path)
+    return load_rb(path)
+
+# append rows to a csv that other processes may be writing to at the same time.
+# the header is only written if the file is empty
+def append_csv(path, header, rows):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            writer = csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            if os.fstat(f.fileno()).st_size == 0:
+                writer.writerow(header)
+            writer.writerows(rows)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# drops the rows whose first column (an iteration) is past max_ix
+def truncate_csv(path, max_ix, header=True):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        rows = list(csv.reader(f, delimiter=',', quotechar='|'))
+    n_head = 1 if header else 0
+    keep = rows[:n_head] + [r for r in rows[n_head:] if len(r) > 0 and int(r[0]) <= max_ix]
+    if len(keep) == len(rows):
+        return
+    with open(path, 'w') as f:
+        csv.writer(f, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL).writerows(keep)
+
+# first column of every row after the header, e.g. the slurm_ids in a sweep's results
+def read_csv_ids(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        rows = list(csv.reader(f, delimiter=',', quotechar='|'))
+    return set(int(r[0]) for r in rows[1:] if len(r) > 0)
+
 def lrange(l, p=0.1):
     return np.linspace(0, (l-1) * p, l)
 